@@ -245,8 +245,8 @@ def analyse(config, argv):
         if mbox:
             representatives = cluster.get_representative_system(
                 lambda x, y:
-                    repo.get_commit(x).author.date >
-                    repo.get_commit(y).author.date)
+                    repo.get_header(x).author.date >
+                    repo.get_header(y).author.date)
         else:
             representatives = cluster.get_representative_system(
                 lambda x, y: config.psd.is_stack_version_greater(
@@ -32,9 +32,8 @@ def shortlog(repo, hash, prefix=''):
 
 def load_subject(message_id):
     # FIXME respect non-unique message ids
-    message = repo.mbox.get_messages(message_id)[0]
-    subject = message['Subject']
-    if subject is None or not isinstance(subject, str):
+    subject = repo.mbox.get_header_records(message_id)[0]['Subject']
+    if subject is None:
         return None
 
     return message_id, subject
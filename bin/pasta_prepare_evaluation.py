@@ -134,8 +134,11 @@ def prepare_process_characteristics(config, clustering):
 
 def prepare_off_list_patches(config, clustering):
     repo = config.repo
-    # We need information of upstream commits, so warm up caches
-    config.load_ccache_upstream()
+    # We need information of upstream commits. The metadata index has
+    # everything we need, otherwise warm up caches.
+    meta = config.load_meta_index()
+    if not meta:
+        config.load_hcache_upstream()
 
     characteristics = load_characteristics(config, clustering)
 
@@ -175,14 +178,24 @@ def prepare_off_list_patches(config, clustering):
         writer = csv.DictWriter(csv_file, fieldnames=csv_fields)
         writer.writeheader()
         for o in sorted(offlist):
-            patch = repo[o]
+            if meta and o in meta:
+                author = meta.get_author(o)[1]
+                committer = meta.get_committer(o)[1]
+                subject = meta.get_subject(o)
+            else:
+                header = repo.get_header(o)
+                author = header.author.email
+                committer = header.committer.email
+                subject = header.subject
             writer.writerow({'commit': o,
-                             'author': patch.author.email.lower(),
-                             'committer': patch.committer.email.lower(),
-                             'subject': patch.subject,
+                             'author': author.lower(),
+                             'committer': committer.lower(),
+                             'subject': subject,
                              'l_down': len(clustering.get_downstream(o)),
-                             'adate': format_date_ymd(patch.author.date),
-                             'cdate': format_date_ymd(patch.committer.date)})
+                             'adate': format_date_ymd(
+                                 repo.get_author_date(o)),
+                             'cdate': format_date_ymd(
+                                 repo.get_committer_date(o))})
 
 
 def prepare_patch_review(config, clustering):
@@ -210,13 +223,23 @@ def prepare_patch_review(config, clustering):
             for node in anytree.PreOrderIter(subthread, filter_=lambda node: node.name != patch_id):
                 responses.append({'resp_msg_id': node.name,
                                   'parent': node.parent.name,
-                                  'message': repo.mbox.get_raws(node.name)})
+                                  'message': None})
 
             clusters_responses.append({'cluster_id': cluster_id,
                                        'patch_id': patch_id,
                                        'upstream': u,
                                        'responses': responses})
 
+    # Read all responses at once, in the order they are stored
+    messages = dict()
+    for cluster in clusters_responses:
+        for response in cluster['responses'] or []:
+            messages.setdefault(response['resp_msg_id'], list()).\
+                append(response)
+    for message_id, raws in repo.mbox.iter_raws(messages.keys()):
+        for response in messages[message_id]:
+            response['message'] = raws
+
     with open(config.f_responses_pkl, 'wb') as handle:
         pickle.dump(clusters_responses, handle, protocol=pickle.HIGHEST_PROTOCOL)
     log.info("Done writing response info for {} patch/commit entries!".format(len(clusters)))
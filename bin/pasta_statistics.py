@@ -60,12 +60,16 @@ def statistics(config, argv):
         export.release_dates(mainline_release_dates_filename,
                              stack_release_dates_filename)
 
-        # If the date_selector is not Stack Release Date (SRD), cache all
-        # commits of the patch stacks, as we need date information of each
-        # of them
-        if args.date_selector != 'SRD':
-            config.load_ccache_stack()
-            repo.cache_commits(psd.commits_on_stacks)
+        # If the date_selector is not Stack Release Date (SRD), we need date
+        # information of all commits of the patch stacks.
+        # Dates are served from the metadata index, if available.
+        if not config.load_meta_index():
+            if args.date_selector != 'SRD':
+                config.load_hcache_stack()
+                repo.cache_headers(psd.commits_on_stacks)
+
+            # Upstream dates of patch groups
+            config.load_hcache_upstream()
 
         # Export information of patch groups
         print('Exporting patch groups...')
@@ -62,6 +62,11 @@ def sync(config, argv):
                         help='Load mailbox subsystem')
     parser.add_argument('-noup', action='store_true', default=False,
                         help='Don\'t synchronise internal index files. ')
+    parser.add_argument('-pack', action='store_true', default=False,
+                        help='Move unpacked raw mails into the raw mail pack')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=1.0, help='CPU factor for parallelisation '
+                                          '(default: %(default)s)')
 
     args = parser.parse_args(argv)
     repo = config.repo
@@ -73,25 +78,38 @@ def sync(config, argv):
         if args.mbox and is_mbox:
             args.create = 'all'
 
-    if is_mbox and (args.create in ['downstream', 'all'] or args.mbox):
+    if is_mbox and (args.create in ['downstream', 'all'] or args.mbox or
+                    args.pack):
         repo.register_mbox(config)
 
+    if is_mbox and args.pack:
+        repo.mbox.pack_raw()
+
     # Update upstream
     if not args.noup:
         config.load_upstream_hashes(force_reload=True)
         if is_mbox and args.mbox:
-            repo.update_mbox(config)
+            repo.update_mbox(config, args.cpu_factor)
 
     create_stack, create_upstream, create_mbox = parse_choices(config, args.create)
     clear_stack, clear_upstream, clear_mbox = parse_choices(config, args.clear)
 
     if clear_stack:
         remove_if_exist(config.f_ccache_stack)
+        remove_if_exist(config.f_hcache_stack)
     if clear_upstream:
         remove_if_exist(config.f_ccache_upstream)
+        remove_if_exist(config.f_hcache_upstream)
     if clear_mbox:
         remove_if_exist(config.f_ccache_mbox)
+        remove_if_exist(config.f_hcache_mbox)
         remove_if_exist(config.f_mail_thread_cache)
+        remove_if_exist(os.path.join(config.d_mbox, 'headers.pack'))
+        remove_if_exist(os.path.join(config.d_mbox, 'headers.pack.idx'))
+    if clear_stack or clear_upstream or clear_mbox:
+        remove_if_exist(config.f_meta_index)
+        remove_if_exist(config.f_dcache)
+        remove_if_exist(config.f_dcache + '.idx')
 
     if create_stack:
         config.update_ccache_stack()
@@ -103,3 +121,7 @@ def sync(config, argv):
         # Update the mail thread cache
         repo.mbox.load_threads()
         repo.mbox.threads.update()
+
+    # The metadata index is built from the header caches
+    if create_stack or create_upstream or create_mbox:
+        config.update_meta_index()
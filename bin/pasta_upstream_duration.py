@@ -31,18 +31,20 @@ def get_youngest(repo, commits, commit_date):
     if len(commits) == 1:
         return oldest, youngest
 
+    if repo.meta and all(x in repo.meta for x in commits):
+        youngest, oldest = repo.meta.extremes(commits, committer=commit_date)
+        return oldest, youngest
+
     if commit_date:
-        for commit in commits[1:]:
-            if repo[youngest].committer.date > repo[commit].committer.date:
-                youngest = commit
-            if repo[oldest].committer.date < repo[commit].committer.date:
-                oldest = commit
+        date = repo.get_committer_date
     else:
-        for commit in commits[1:]:
-            if repo[youngest].author.date > repo[commit].author.date:
-                youngest = commit
-            if repo[oldest].author.date < repo[commit].author.date:
-                oldest = commit
+        date = repo.get_author_date
+
+    for commit in commits[1:]:
+        if date(youngest) > date(commit):
+            youngest = commit
+        if date(oldest) < date(commit):
+            oldest = commit
 
     return oldest, youngest
 
@@ -57,10 +59,10 @@ def upstream_duration_of_group(group):
     oldest_mail, youngest_mail = get_youngest(repo, untagged, False)
     _, youngest_upstream = get_youngest(repo, tagged, True)
 
-    oldest_mail_date = repo[oldest_mail].author.date
-    youngest_mail_date = repo[youngest_mail].author.date
+    oldest_mail_date = repo.get_author_date(oldest_mail)
+    youngest_mail_date = repo.get_author_date(youngest_mail)
 
-    youngest_upstream_date = repo[youngest_upstream].committer.date
+    youngest_upstream_date = repo.get_committer_date(youngest_upstream)
 
     delta = youngest_upstream_date - youngest_mail_date
 
@@ -80,10 +82,13 @@ def upstream_duration(config, argv):
 
     _, cluster = config.load_cluster()
 
-    if config.mode == Config.Mode.MBOX:
-        config.load_ccache_mbox()
-    else:
-        config.load_ccache_stack()
+    # Dates are all we need: prefer the metadata index, fall back to headers
+    if not config.load_meta_index():
+        if config.mode == Config.Mode.MBOX:
+            config.load_hcache_mbox()
+        else:
+            config.load_hcache_stack()
+        config.load_hcache_upstream()
 
     log.info('Starting evaluation.')
     pool = Pool(cpu_count())
@@ -18,9 +18,8 @@
         # fuzzy patch similarity scoring (PatchEvaluation.py, pasta_check_mbox)
         thefuzz
 
-        # git repository access: pygit2 for low-level, gitpython for pasta_patch_descriptions
+        # git repository access
         pygit2
-        gitpython
 
         # maintainer graph analysis (MAINTAINERS.py, pasta_maintainers_stats)
         networkx
@@ -28,6 +27,12 @@
         # cluster quality metrics (pasta_compare_clusters)
         scikit-learn
 
+        # columnar metadata and mail indices (MetaIndex.py, MailIndex.py)
+        numpy
+
+        # optional: compression of packed raw mails (RawPack.py)
+        zstandard
+
         # progress bars (MAINTAINERS.py, pasta_upstream_duration)
         tqdm
 
@@ -36,6 +41,9 @@
 
         # interactive development
         ipython
+
+        # test suite (tests/)
+        pytest
       ]);
 
       rEnv = pkgs.rWrapper.override {
@@ -63,12 +71,10 @@
           # version control
           git
 
-          # filterdiff: convert context diffs to unified (Repository/Patch.py)
+          # tests only: filterdiff is the reference for converting context
+          # diffs (tests/test_context_to_unified.py)
           patchutils
 
-          # formail: split mbox files for mailbox processing (process_mailbox_maildir.sh)
-          procmail
-
           # get_maintainer.pl is a perl script from the Linux kernel tree
           perl
 
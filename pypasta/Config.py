@@ -13,14 +13,16 @@ the COPYING file in the top-level directory.
 import tomllib
 
 from enum import Enum
-from os.path import join, realpath, isfile, isdir, isabs
+from pygit2 import Oid
+from os.path import join, realpath, isfile, isdir, isabs, splitext
 from os import makedirs
 from logging import getLogger
 
 from .Clustering import Clustering
 from .Repository import Repository
 from .PatchStack import PatchStackDefinition
-from .Util import load_commit_hashes, persist_commit_hashes, parse_date_ymd
+from .Util import load_commit_hashes, persist_commit_hashes, \
+    parse_date_ymd, resolve_commit_range, walk_commits
 
 log = getLogger(__name__[-15:])
 
@@ -119,16 +121,25 @@ class Config:
         if not self.repo_location:
             raise RuntimeError('Location of repository not found')
         self.repo_location = join(self._project_root, self.repo_location)
-        self.repo = Repository(self.project_name, self.repo_location)
+
+        def path(name, default=None):
+            # Locations that were introduced later on fall back to a default,
+            # as older default configurations don't know them
+            if default is not None:
+                return join(self._project_root, pasta.get(name, default))
+            return join(self._project_root, pasta[name])
+
+        self.f_tags = path('TAG_CACHE', 'resources/tags.pkl')
+        self.f_releases_index = path('RELEASES_INDEX',
+                                     'resources/releases.pkl')
+        self.repo = Repository(self.project_name, self.repo_location,
+                               self.f_tags)
 
         self.upstream_range = pasta.get('UPSTREAM')
         if not self.upstream_range:
             raise RuntimeError('Please provide a valid upstream range in your '
                                'config')
 
-        def path(name):
-            return join(self._project_root, pasta[name])
-
         # parse locations, those will fallback to default values
         self.f_patch_stack_definition = path('PATCH_STACK_DEFINITION')
 
@@ -157,6 +168,18 @@ class Config:
         self.f_ccache_upstream = path('COMMIT_CACHE_UPSTREAM')
         self.f_ccache_mbox = path('COMMIT_CACHE_MBOX')
 
+        # header caches live next to their commit caches
+        self.f_hcache_stack = Config._hcache_location(self.f_ccache_stack)
+        self.f_hcache_upstream = \
+            Config._hcache_location(self.f_ccache_upstream)
+        self.f_hcache_mbox = Config._hcache_location(self.f_ccache_mbox)
+
+        # content-addressed cache of parsed diffs
+        self.f_dcache = path('DIFF_CACHE', 'resources/diffs.pack')
+
+        # columnar metadata index of commits and mails
+        self.f_meta_index = path('META_INDEX', 'resources/meta-index.pkl')
+
         self.f_characteristics = path('CHARACTERISTICS')
         self.f_maintainers_stats = path('MAINTAINERS_STATS')
         self.d_maintainers_section_graph = path('MAINTAINERS_SECTION_GRAPH')
@@ -206,31 +229,68 @@ class Config:
     def project_root(self):
         return self._project_root
 
+    @staticmethod
+    def _hcache_location(f_ccache):
+        return '%s-headers.pkl' % splitext(f_ccache)[0]
+
     def load_ccache_upstream(self):
+        self.repo.load_dcache(self.f_dcache)
         self.repo.load_ccache(self.f_ccache_upstream, 'upstream')
 
     def load_ccache_mbox(self):
+        self.repo.load_dcache(self.f_dcache)
         self.repo.load_ccache(self.f_ccache_mbox, 'mbox')
 
     def load_ccache_stack(self):
+        self.repo.load_dcache(self.f_dcache)
         self.repo.load_ccache(self.f_ccache_stack, 'stack')
 
+    def load_hcache_upstream(self):
+        self.repo.load_hcache(self.f_hcache_upstream, 'upstream')
+
+    def load_hcache_mbox(self):
+        self.repo.load_hcache(self.f_hcache_mbox, 'mbox')
+
+    def load_hcache_stack(self):
+        self.repo.load_hcache(self.f_hcache_stack, 'stack')
+
+    def load_releases_index(self):
+        self.repo.load_releases(self.f_releases_index)
+
+    def load_meta_index(self):
+        return self.repo.load_meta(self.f_meta_index)
+
+    def update_meta_index(self):
+        """
+        (Re)builds the metadata index from the header caches
+        """
+        repo = self.repo
+        repo.clear_commit_cache()
+        self.load_hcache_upstream()
+        if self._mode == Config.Mode.MBOX:
+            repo.register_mbox(self)
+            self.load_hcache_mbox()
+        else:
+            self.load_hcache_stack()
+        repo.export_meta(self.f_meta_index)
+        repo.clear_commit_cache()
+
     def _update_ccache(self, f_ccache, ids, desc):
         repo = self.repo
-        changed = False
         ids = set(ids)
+        f_hcache = Config._hcache_location(f_ccache)
+
+        # Caches are updated on disk, without ever holding them in memory
         repo.clear_commit_cache()
-        already_cached = repo.load_ccache(f_ccache, desc)
-        evicted = repo.cache_evict_except(ids)
-        if len(evicted):
-            changed = True
-        already_cached -= evicted
-        if len(ids - already_cached):
-            repo.cache_commits(ids)
-            changed = True
-
-        if changed:
-            repo.export_ccache(f_ccache)
+        repo.load_dcache(self.f_dcache)
+        cached, pruned = repo.prune_store(f_ccache, f_hcache, ids, desc)
+        if pruned:
+            repo.prune_dcache([self.f_hcache_upstream, self.f_hcache_mbox,
+                               self.f_hcache_stack])
+        worklist = ids - cached
+        if worklist:
+            repo.cache_commits(worklist,
+                               store=(f_ccache, f_hcache, self.f_dcache))
         repo.clear_commit_cache()
 
     def update_ccache_upstream(self):
@@ -269,6 +329,57 @@ class Config:
 
         return f_clustering, cluster
 
+    @staticmethod
+    def _format_upstream_tip(include, exclude):
+        return '# tip: ' + ' '.join([str(x) for x in include] +
+                                    ['^%s' % x for x in exclude])
+
+    def _update_upstream_hashes(self, upstream):
+        """
+        Walks from the previously stored tip of the upstream range to the
+        current one, and appends new commit hashes to the upstream commit hash
+        file. Returns None if history was rewritten.
+        """
+        repo = self.repo.repo
+
+        tip = None
+        with open(self.f_upstream_hashes, 'r') as f:
+            for line in f:
+                if line.startswith('# tip: '):
+                    tip = line.rstrip('\n')
+        if tip is None:
+            return None
+
+        include, exclude = resolve_commit_range(repo, self.upstream_range)
+        if tip == Config._format_upstream_tip(include, exclude):
+            return upstream
+
+        old = tip[len('# tip: '):].split()
+        old_include = [Oid(hex=x) for x in old if not x.startswith('^')]
+        old_exclude = [Oid(hex=x[1:]) for x in old if x.startswith('^')]
+
+        # The excluded side must be stable, and every old tip must still be
+        # part of the history. Otherwise, history was rewritten.
+        if old_exclude != exclude:
+            return None
+        try:
+            for old_tip in old_include:
+                if not any(x == old_tip or repo.descendant_of(x, old_tip)
+                           for x in include):
+                    return None
+        except KeyError:
+            # The old tip vanished
+            return None
+
+        new = walk_commits(repo, include, exclude + old_include)
+        log.info('Appending %d new upstream commit hashes' % len(new))
+        persist_commit_hashes(self.f_upstream_hashes,
+                              new + [Config._format_upstream_tip(include,
+                                                                 exclude)],
+                              append=True)
+
+        return upstream + new
+
     def load_upstream_hashes(self, force_reload=False):
         # check if upstream commit hashes are existent. If not, create them
         upstream = None
@@ -276,17 +387,24 @@ class Config:
             upstream = load_commit_hashes(self.f_upstream_hashes)
 
             # check if upstream range in the config file is in sync
-            if not upstream or upstream.pop(0) != self.upstream_range or \
-               force_reload:
+            if not upstream or upstream.pop(0) != self.upstream_range:
                 # set upstream to None if inconsistencies are detected.
                 # upstream commit hash file will be renewed in the next step.
                 upstream = None
+            elif force_reload:
+                # Only walk new commits. If this doesn't work out, renew the
+                # whole file in the next step.
+                upstream = self._update_upstream_hashes(upstream)
 
         if not upstream:
             log.info('Renewing upstream commit hash file')
-            upstream = self.repo.get_commithash_range(self.upstream_range)
+            repo = self.repo.repo
+            include, exclude = resolve_commit_range(repo, self.upstream_range)
+            upstream = walk_commits(repo, include, exclude)
             persist_commit_hashes(self.f_upstream_hashes,
-                                  [self.upstream_range] + upstream)
+                                  [self.upstream_range] + upstream +
+                                  [Config._format_upstream_tip(include,
+                                                               exclude)])
             log.info('  ↪ done')
 
         if self.upstream_blacklist:
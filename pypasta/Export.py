@@ -121,12 +121,12 @@ class Export:
             # optional: write upstream information
             commit = get_first_upstream(self.repo, cluster, d[0])
             if commit:
-                commit = self.repo[commit]
                 first_stack_occurence = min(map(date_selector, d))
 
                 upstream.write('%d,%s,%s,%s\n' %
-                               (cntr, commit.identifier,
-                                format_date_ymd(commit.committer.date),
+                               (cntr, commit,
+                                format_date_ymd(
+                                    self.repo.get_committer_date(commit)),
                                 format_date_ymd(first_stack_occurence)))
 
             # Patch occurrence
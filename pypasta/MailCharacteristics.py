@@ -11,7 +11,6 @@ the COPYING file in the top-level directory.
 """
 
 import csv
-import email
 import re
 
 from anytree import LevelOrderIter
@@ -22,14 +21,12 @@ from multiprocessing import cpu_count
 from tqdm import tqdm
 
 from .MAINTAINERS import load_maintainers
-from .Util import get_first_upstream, load_pkl_and_update, mail_parse_date, \
+from .Repository.MailHeader import email_get_header_normalised
+from .Util import get_first_upstream, load_pkl_and_update, \
     remove_general_sections
 
 log = getLogger(__name__[-15:])
 
-
-VALID_EMAIL_REGEX = re.compile(r'.+@.+\..+')
-
 _repo = None
 _maintainers_version = None
 _clustering = None
@@ -48,31 +45,6 @@ class PatchType(Enum):
     OTHER = 'other'
 
 
-def email_get_recipients(message):
-    recipients = message.get_all('To', []) + message.get_all('Cc', [])
-    recipients = list(filter(None, recipients))
-    # get_all might return Header objects. Convert them all to strings.
-    recipients = [str(x) for x in recipients]
-
-    # Only accept valid email addresses
-    recipients = {x[1].lower() for x in email.utils.getaddresses(recipients)
-                  if VALID_EMAIL_REGEX.match(x[1])}
-
-    return recipients
-
-
-def email_get_header_normalised(message, header):
-    header = str(message[header] or '').lower()
-    header = header.replace('\n', '').replace('\t', ' ')
-
-    return header
-
-
-def email_get_from(message):
-    mail_from = email_get_header_normalised(message, 'From')
-    return email.utils.parseaddr(mail_from)
-
-
 class MailCharacteristics:
     REGEX_COVER = re.compile(r'\[.*patch.*\s0+/.*\].*', re.IGNORECASE)
     REGEX_GREG_ADDED = re.compile('patch \".*\" added to .*')
@@ -118,7 +90,7 @@ class MailCharacteristics:
             if mail.name not in repo:
                 continue
 
-            this_email = email_get_from(repo.mbox.get_messages(mail.name)[0])[1]
+            this_email = repo.mbox.get_header_records(mail.name)[0].mail_from[1]
             if this_email != self.mail_from[1]:
                 return True
         return False
@@ -302,16 +274,17 @@ class MailCharacteristics:
     def __init__(self, repo, clustering, message_id):
         self.message_id = message_id
 
-        self.message = repo.mbox.get_messages(message_id)[0]
+        # The header record of the mail serves as message
+        self.message = repo.mbox.get_header_records(message_id)[0]
         self.thread = repo.mbox.threads.get_thread(message_id)
-        self.recipients = email_get_recipients(self.message)
+        self.recipients = set(self.message.recipients)
 
         self.recipients_lists = self.recipients & (repo.mbox.lists | self.LISTS)
         self.recipients_other = self.recipients - (repo.mbox.lists | self.LISTS)
 
-        self.mail_from = email_get_from(self.message)
+        self.mail_from = self.message.mail_from
         self.subject = email_get_header_normalised(self.message, 'Subject')
-        self.date = mail_parse_date(self.message['Date'])
+        self.date = self.message.date
 
         self.lists = repo.mbox.get_lists(message_id)
 
@@ -419,9 +392,11 @@ def load_characteristics(config, clustering, message_ids = None):
         raise NotImplementedError('Missing code for project %s' %
                                   config.project_name)
 
-    # Characteristics need thread information. Ensure it's loaded.
+    # Characteristics need thread information and header records. Ensure
+    # they're loaded.
     repo = config.repo
     repo.mbox.load_threads()
+    repo.mbox.load_header_records()
 
     if not message_ids:
         message_ids = repo.mbox.get_ids(config.mbox_time_window,
@@ -432,6 +407,7 @@ def load_characteristics(config, clustering, message_ids = None):
         # We can safely limit to patches only, as only patches will be used for
         # the maintainers analysis.
         patches = message_ids - repo.mbox.invalid
+        repo.cache_commits(patches)
         log.info('Determining kernel versions for %d patches...' % len(patches))
         tags = {repo.patch_get_version(repo[x])
                 for x in tqdm(patches, desc='Patch versions', unit='patch')}
@@ -445,6 +421,9 @@ def load_characteristics(config, clustering, message_ids = None):
         if len(missing) == 0:
             return ret, False
 
+        # Read patches in bulk, before the workers need them
+        repo.cache_commits(missing - repo.mbox.invalid)
+
         global _repo, _maintainers_version, _clustering, _characteristics_class
         _maintainers_version = maintainers_version
         _clustering = clustering
@@ -528,7 +528,7 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
     def file_commit_map(hashes):
         ret = defaultdict(set)
         for hash in hashes:
-            files = repo[hash].diff.affected
+            files = repo.get_header(hash).affected
             for file in files:
                 ret[file].add(hash)
         return ret
@@ -546,7 +546,7 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
         log.info('Creating preevaluation result...')
         for left_hash in tqdm(left_hashes, desc='Preevaluation', unit='patch'):
             this_right_hashes = set()
-            affects = repo[left_hash].diff.affected
+            affects = repo.get_header(left_hash).affected
             for affect in affects:
                 if affect in right_files:
                     this_right_hashes |= right_files[affect]
@@ -585,9 +585,9 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
                 right_hashes |= right_files[right_file]
 
             for left_hash in left_hashes:
-                left = repo[left_hash]
+                left = repo.get_header(left_hash)
                 for right_hash in right_hashes:
-                    right = repo[right_hash]
+                    right = repo.get_header(right_hash)
                     # don't compare revert patches
                     if left.is_revert != right.is_revert:
                         continue
@@ -605,9 +605,9 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
     # distance of author_date_interval days
     if thresholds.author_date_interval:
         for left_hash, right_hashes in preeval_result.items():
-            left_author_date = repo[left_hash].author.date
+            left_author_date = repo.get_header(left_hash).author.date
             right_hashes -= {x for x in right_hashes
-                             if abs((repo[x].author.date - left_author_date).days) >= thresholds.author_date_interval}
+                             if abs((repo.get_header(x).author.date - left_author_date).days) >= thresholds.author_date_interval}
 
     # filter for empty entries
     preeval_result = {k: v for k, v in preeval_result.items() if len(v)}
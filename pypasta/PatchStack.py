@@ -222,7 +222,8 @@ class PatchStackDefinition:
 
         log.info('  ↪ done')
 
-        patch_stack_groups = []
+        groups = []
+        missing = []
         for group_name, csv_list in csv_groups:
             reader = csv.DictReader(csv_list, dialect='patchstack')
             this_group = []
@@ -237,21 +238,31 @@ class PatchStackDefinition:
 
                 stack_hashes_location = os.path.join(config.d_stack_hashes,
                                                      stack.version)
+                if not os.path.isfile(stack_hashes_location):
+                    missing.append((base, stack, stack_hashes_location))
+
+                this_group.append((base, stack, stack_hashes_location))
 
-                # check if stack hashes are existent. If not, create them
-                if os.path.isfile(stack_hashes_location):
-                    commit_hashes = load_commit_hashes(stack_hashes_location)
-                else:
-                    log.info('Calculating missing stack hashes for %s' %
-                             stack.commit)
-                    commit_hashes = repo.cherry(base.commit,
-                                                stack.commit)
-                    persist_commit_hashes(stack_hashes_location, commit_hashes)
-                    log.info('  ↪ done')
+            groups.append((group_name, this_group))
 
-                this_group.append(PatchStack(base, stack, commit_hashes))
+        # Create all missing stack hashes at once
+        if missing:
+            log.info('Calculating missing stack hashes for %d stacks' %
+                     len(missing))
+            cherries = repo.cherries([(base.commit, stack.commit)
+                                      for base, stack, _ in missing])
+            for (_, _, stack_hashes_location), commit_hashes in \
+                    zip(missing, cherries):
+                persist_commit_hashes(stack_hashes_location, commit_hashes)
+            log.info('  ↪ done')
 
-            patch_stack_groups.append((group_name, this_group))
+        patch_stack_groups = []
+        for group_name, this_group in groups:
+            patch_stack_groups.append(
+                (group_name,
+                 [PatchStack(base, stack,
+                             load_commit_hashes(stack_hashes_location))
+                  for base, stack, stack_hashes_location in this_group]))
 
         # Create patch stack list
         return PatchStackDefinition(patch_stack_groups)
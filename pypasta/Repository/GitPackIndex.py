@@ -0,0 +1,96 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import numpy as np
+
+from glob import glob
+from logging import getLogger
+from os.path import join
+
+log = getLogger(__name__[-15:])
+
+
+class GitPackIndex:
+    """
+    Positions of objects in the packs of a git repository, as found in the
+    pack index files (version 2). libgit2 doesn't expose them, but reading
+    objects in pack order greatly improves locality.
+    """
+    MAGIC = b'\377tOc'
+    LARGE_OFFSET = 0x80000000
+
+    def __init__(self, d_repo):
+        self.oids = list()
+        self.offsets = list()
+
+        for f_idx in sorted(glob(join(d_repo, 'objects', 'pack', '*.idx'))):
+            try:
+                oids, offsets = self.parse(f_idx)
+            except ValueError as e:
+                log.warning('Unable to parse %s: %s' % (f_idx, e))
+                continue
+            self.oids.append(oids)
+            self.offsets.append(offsets)
+
+    @staticmethod
+    def parse(f_idx):
+        with open(f_idx, 'rb') as f:
+            data = f.read()
+
+        if data[0:4] != GitPackIndex.MAGIC or \
+           int.from_bytes(data[4:8], 'big') != 2:
+            raise ValueError('unsupported pack index')
+
+        num = int.from_bytes(data[8 + 255 * 4:8 + 256 * 4], 'big')
+        pos = 8 + 256 * 4
+        # Sorted by git itself
+        oids = np.frombuffer(data, dtype='S20', count=num, offset=pos)
+        pos += num * 20
+        # Skip CRCs
+        pos += num * 4
+        offsets = np.frombuffer(data, dtype='>u4', count=num,
+                                offset=pos).astype(np.uint64)
+        pos += num * 4
+
+        large = (offsets & GitPackIndex.LARGE_OFFSET) != 0
+        if large.any():
+            num_large = int((offsets[large] & ~np.uint64(
+                GitPackIndex.LARGE_OFFSET)).max()) + 1
+            table = np.frombuffer(data, dtype='>u8', count=num_large,
+                                  offset=pos).astype(np.uint64)
+            offsets[large] = table[(offsets[large] &
+                                    ~np.uint64(GitPackIndex.LARGE_OFFSET)).
+                                   astype(np.int64)]
+
+        return oids, offsets
+
+    def order(self, oids):
+        """
+        :param oids: list of hex object ids
+        :return: positions of oids, sorted by their location in the packs.
+                 Unpacked objects come last.
+        """
+        keys = np.array([bytes.fromhex(oid) for oid in oids], dtype='S20')
+        packs = np.full(len(oids), len(self.oids), dtype=np.int64)
+        offsets = np.zeros(len(oids), dtype=np.uint64)
+
+        for num, (pack_oids, pack_offsets) in enumerate(zip(self.oids,
+                                                            self.offsets)):
+            if not len(pack_oids):
+                continue
+            pos = np.searchsorted(pack_oids, keys)
+            pos = np.minimum(pos, len(pack_oids) - 1)
+            found = (pack_oids[pos] == keys) & (packs == len(self.oids))
+            packs[found] = num
+            offsets[found] = pack_offsets[pos[found]]
+
+        return np.lexsort((offsets, packs))
@@ -0,0 +1,119 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import email
+import re
+
+from email.header import Header
+from sys import intern
+
+from ..Util import mail_parse_date
+
+ID_REGEX = re.compile(r'(<\S+>)')
+VALID_EMAIL_REGEX = re.compile(r'.+@.+\..+')
+
+
+def sanitise_header(message, header):
+    contents = message.get_all(header)
+    ids = set()
+
+    if not contents:
+        return ids
+
+    for content in contents:
+        # special treatment for mails with unknown encoding in their headers
+        if isinstance(content, Header):
+            content = bytearray(content._chunks[0][0], 'utf-8',
+                                'ignore').decode()
+
+        ids |= set(ID_REGEX.findall(content))
+
+    return ids
+
+
+def email_get_recipients(message):
+    recipients = message.get_all('To', []) + message.get_all('Cc', [])
+    recipients = list(filter(None, recipients))
+    # get_all might return Header objects. Convert them all to strings.
+    recipients = [str(x) for x in recipients]
+
+    # Only accept valid email addresses. Addresses massively repeat across
+    # mails, so intern them.
+    recipients = {intern(x[1].lower())
+                  for x in email.utils.getaddresses(recipients)
+                  if VALID_EMAIL_REGEX.match(x[1])}
+
+    return recipients
+
+
+def email_get_header_normalised(message, header):
+    header = str(message[header] or '').lower()
+    header = header.replace('\n', '').replace('\t', ' ')
+
+    return header
+
+
+def email_get_from(message):
+    mail_from = email_get_header_normalised(message, 'From')
+    return email.utils.parseaddr(mail_from)
+
+
+class MailHeader:
+    """
+    Parsed headers of a single mail. Records are computed once when mails are
+    ingested, and spare consumers from parsing mails over and over again.
+
+    Besides parsed fields, a record keeps the raw values of a few headers
+    and can be indexed like an email message for those.
+    """
+    HEADERS = ('from', 'subject', 'date', 'user-agent', 'x-mailer',
+               'x-patchwork-hint', 'x-stable')
+
+    __slots__ = ('mail_from', 'recipients', 'epoch', 'offset', 'message_ids',
+                 'in_reply_to', 'references', 'headers')
+
+    def __init__(self, message):
+        self.mail_from = email_get_from(message)
+        self.recipients = frozenset(email_get_recipients(message))
+
+        date = mail_parse_date(message['Date'])
+        self.epoch = int(date.timestamp())
+        self.offset = int(date.utcoffset().total_seconds())
+
+        self.message_ids = frozenset(sanitise_header(message, 'message-id'))
+        self.in_reply_to = frozenset(sanitise_header(message, 'in-reply-to'))
+        self.references = frozenset(sanitise_header(message, 'references'))
+
+        self.headers = {name: str(message[name]) for name in self.HEADERS
+                        if message[name] is not None}
+
+    @property
+    def date(self):
+        tz = datetime.timezone(datetime.timedelta(seconds=self.offset))
+        return datetime.datetime.fromtimestamp(self.epoch, tz)
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower())
+
+    def __contains__(self, name):
+        return name.lower() in self.headers
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+        # Addresses massively repeat across mails
+        self.mail_from = tuple(map(intern, self.mail_from))
+        self.recipients = frozenset(map(intern, self.recipients))
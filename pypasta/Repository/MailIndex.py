@@ -0,0 +1,424 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import mmap
+import numpy as np
+import os
+import struct
+
+from hashlib import blake2b
+from logging import getLogger
+from os.path import dirname, isfile
+
+log = getLogger(__name__[-15:])
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def id_hash(message_id):
+    digest = blake2b(message_id.encode('utf-8', 'surrogateescape'),
+                     digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def day_to_datetime(day):
+    return datetime.datetime.fromordinal(int(day) + EPOCH_ORDINAL)
+
+
+def source_stamp(f_index):
+    try:
+        stat = os.stat(f_index)
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_size, stat.st_mtime_ns
+
+
+class MailIndex:
+    """
+    Binary index of a mail container. Rows are sorted by a 64-bit hash of
+    their message id, and lookups bisect over the hash column. All columns
+    are memory-mapped from disk, nothing is materialised on load.
+
+    Columns:
+      hashes:     uint64, hash of the message id
+      days:       int32, days since the epoch
+      locations:  fixed width bytes, the location of the mail in its container
+      containers: uint16, the container of the mail in merged indices
+      blobs:      fixed width bytes, the git blob of the mail in public
+                  inboxes, empty if unknown
+      fingerprints: uint64, fingerprint of the content of the mail, UNKNOWN
+                  or UNREADABLE if there is none
+      duplicates: bool, the row is a copy of an earlier row with the same
+                  message id and fingerprint
+      id_ptr:     uint64, start of the row's message id in id_blob
+      id_blob:    newline-separated message ids, in row order
+
+    Besides, by_date lists all rows sorted by their day, and sorted_days
+    holds the days in that order. Time windows are resolved by bisecting
+    sorted_days.
+
+    The text index stays the primary source. A binary index carries a
+    stamp (size and mtime) of the text index it was built from, and is
+    regenerated if the text index changed.
+    """
+    # Fingerprints of mails that still need to be read, and of mails that
+    # can't be read
+    UNKNOWN = 0
+    UNREADABLE = (1 << 64) - 1
+
+    MAGIC = b'PaStAmix'
+    VERSION = 5
+    # magic, version, location width, blob width, rows, id_blob size, source
+    # stamp
+    HEADER = struct.Struct('<8sIIIQQqq')
+
+    def __init__(self, hashes, days, locations, blobs, fingerprints,
+                 duplicates, containers, id_ptr, id_blob, by_date, sorted_days,
+                 stamp=None, mm=None):
+        self.hashes = hashes
+        self.days = days
+        self.blobs = blobs
+        self.fingerprints = fingerprints
+        self.duplicates = duplicates
+        self.by_date = by_date
+        self.sorted_days = sorted_days
+        self.locations = locations
+        self.containers = containers
+        self.id_ptr = id_ptr
+        self.id_blob = id_blob
+        self.stamp = stamp
+        # Keep the mapping alive as long as its views
+        self._mm = mm
+
+    @staticmethod
+    def from_entries(entries):
+        """
+        :param entries: iterable of tuples (message_id, date_str, location,
+               blob, fingerprint), with date_str in the format YYYY/MM/DD
+        """
+        day_cache = dict()
+
+        def day(date_str):
+            if date_str not in day_cache:
+                year, month, mday = date_str.split('/')
+                day_cache[date_str] = datetime.date(
+                    int(year), int(month), int(mday)).toordinal() - \
+                    EPOCH_ORDINAL
+            return day_cache[date_str]
+
+        rows = sorted((id_hash(message_id), message_id, day(date_str),
+                       location, blob, fingerprint) for
+                      message_id, date_str, location, blob, fingerprint in
+                      entries)
+
+        num = len(rows)
+        width = max((len(row[3]) for row in rows), default=1)
+        hashes = np.fromiter((row[0] for row in rows), dtype=np.uint64,
+                             count=num)
+        days = np.fromiter((row[2] for row in rows), dtype=np.int32,
+                           count=num)
+        locations = np.array([row[3].encode('ascii') for row in rows],
+                             dtype='S%u' % width)
+        width = max((len(row[4]) for row in rows), default=1) or 1
+        blobs = np.array([row[4].encode('ascii') for row in rows],
+                         dtype='S%u' % width)
+        fingerprints = np.fromiter((row[5] for row in rows), dtype=np.uint64,
+                                   count=num)
+        ids = [row[1] for row in rows]
+
+        return MailIndex.from_columns(hashes, days, locations, blobs,
+                                      fingerprints,
+                                      np.zeros(num, dtype=np.uint16), ids)
+
+    @staticmethod
+    def find_duplicates(hashes, fingerprints):
+        """
+        Mark rows that repeat an earlier row with the same message id and
+        fingerprint. Rows must be sorted by their hash. Different message ids
+        that share their hash would also need to share their content, which
+        is ignored.
+        """
+        order = np.lexsort((np.arange(len(hashes)), fingerprints, hashes))
+        hashes = hashes[order]
+        fingerprints = fingerprints[order]
+
+        duplicates = np.zeros(len(hashes), dtype=np.bool_)
+        duplicates[order[1:]] = (hashes[1:] == hashes[:-1]) & \
+                                (fingerprints[1:] == fingerprints[:-1]) & \
+                                (fingerprints[1:] != MailIndex.UNKNOWN) & \
+                                (fingerprints[1:] != MailIndex.UNREADABLE)
+        return duplicates
+
+    @staticmethod
+    def from_columns(hashes, days, locations, blobs, fingerprints, containers,
+                     ids):
+        encoded = [message_id.encode('utf-8', 'surrogateescape') for
+                   message_id in ids]
+        id_ptr = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        # + 1 for the separating newline
+        np.cumsum([len(x) + 1 for x in encoded], out=id_ptr[1:])
+        id_blob = np.frombuffer(b'\n'.join(encoded), dtype=np.uint8)
+        by_date = np.argsort(days, kind='stable').astype(np.int64)
+
+        return MailIndex(hashes, days, locations, blobs, fingerprints,
+                         MailIndex.find_duplicates(hashes, fingerprints),
+                         containers, id_ptr, id_blob, by_date, days[by_date])
+
+    @staticmethod
+    def parse_text(f_index):
+        if not isfile(f_index):
+            return
+
+        with open(f_index, 'r', errors='surrogateescape') as f:
+            for line in f:
+                entry = line.split()
+                if len(entry) < 3:
+                    continue
+                date_str, message_id, location = entry[0:3]
+                # Mails outside of public inboxes don't have a blob
+                blob = entry[3] if len(entry) > 3 and entry[3] != '-' else ''
+                fingerprint = int(entry[4], 16) if len(entry) > 4 else \
+                    MailIndex.UNKNOWN
+                yield message_id, date_str, location, blob, fingerprint
+
+    @staticmethod
+    def load(f_index, f_bin):
+        """
+        Map the binary index f_bin, or regenerate it from the text index
+        f_index if it is missing or outdated.
+        """
+        stamp = source_stamp(f_index)
+        index = MailIndex.map(f_bin, stamp)
+        if index is None:
+            index = MailIndex.from_entries(MailIndex.parse_text(f_index))
+            index.export(f_bin, stamp)
+            index = MailIndex.map(f_bin, stamp)
+
+        return index
+
+    @staticmethod
+    def combine_stamps(stamps):
+        """
+        Stamp of an index that is derived from several sources
+        """
+        digest = blake2b(repr(list(stamps)).encode(), digest_size=8).digest()
+        return len(stamps), int.from_bytes(digest, 'little', signed=True)
+
+    @staticmethod
+    def load_merged(f_bin, sources):
+        """
+        Map the merged index of several containers, or regenerate it if any
+        of the containers changed.
+        :param sources: list of tuples (name, index), the position in the
+               list is the container number
+        """
+        stamp = MailIndex.combine_stamps([(name, index.stamp) for
+                                          name, index in sources])
+        merged = MailIndex.map(f_bin, stamp)
+        if merged is None:
+            merged = MailIndex.merge([index for _, index in sources],
+                                     containers=range(len(sources)))
+            merged.export(f_bin, stamp)
+            merged = MailIndex.map(f_bin, stamp)
+
+        return merged
+
+    @staticmethod
+    def map(f_bin, stamp):
+        try:
+            with open(f_bin, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if len(mm) < MailIndex.HEADER.size:
+            return None
+
+        magic, version, width, blob_width, num, blob_size, size, mtime = \
+            MailIndex.HEADER.unpack_from(mm)
+        if magic != MailIndex.MAGIC or version != MailIndex.VERSION or \
+           (size, mtime) != stamp:
+            return None
+
+        offset = MailIndex.HEADER.size
+
+        def column(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            offset += -offset % 8
+            return array
+
+        hashes = column(np.uint64, num)
+        id_ptr = column(np.uint64, num + 1)
+        days = column(np.int32, num)
+        containers = column(np.uint16, num)
+        by_date = column(np.int64, num)
+        sorted_days = column(np.int32, num)
+        locations = column('S%u' % width, num)
+        blobs = column('S%u' % blob_width, num)
+        fingerprints = column(np.uint64, num)
+        duplicates = column(np.bool_, num)
+        id_blob = column(np.uint8, blob_size)
+
+        return MailIndex(hashes, days, locations, blobs, fingerprints,
+                         duplicates, containers, id_ptr, id_blob, by_date,
+                         sorted_days, stamp, mm)
+
+    def export(self, f_bin, stamp):
+        os.makedirs(dirname(f_bin), exist_ok=True)
+        f_tmp = f_bin + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                     self.locations.dtype.itemsize,
+                                     self.blobs.dtype.itemsize,
+                                     len(self), len(self.id_blob), *stamp))
+            for array in (self.hashes, self.id_ptr, self.days,
+                          self.containers, self.by_date, self.sorted_days,
+                          self.locations, self.blobs, self.fingerprints,
+                          self.duplicates, self.id_blob):
+                f.write(array.tobytes())
+                f.write(b'\0' * (-f.tell() % 8))
+        os.replace(f_tmp, f_bin)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get_id(self, row):
+        start, end = self.id_ptr[row], self.id_ptr[row + 1] - 1
+        return self.id_blob[start:end].tobytes().decode('utf-8',
+                                                        'surrogateescape')
+
+    def get_ids(self):
+        if not len(self):
+            return []
+        return self.id_blob.tobytes().decode('utf-8',
+                                             'surrogateescape').split('\n')
+
+    def lookup(self, message_id, duplicates=True):
+        """
+        :param duplicates: Include rows that are copies of earlier rows
+        :return: rows of message_id
+        """
+        h = np.uint64(id_hash(message_id))
+        lo = int(np.searchsorted(self.hashes, h, side='left'))
+        hi = int(np.searchsorted(self.hashes, h, side='right'))
+
+        # Different message ids may share their hash
+        return [row for row in range(lo, hi) if self.get_id(row) == message_id
+                and (duplicates or not self.duplicates[row])]
+
+    def __contains__(self, message_id):
+        return len(self.lookup(message_id)) > 0
+
+    def get_container(self, row):
+        return int(self.containers[row])
+
+    def get_entry(self, row):
+        """
+        :return: tuple (datetime, date_str, location, blob) of a row
+        """
+        dtime = day_to_datetime(self.days[row])
+        return dtime, dtime.strftime('%04Y/%m/%d'), \
+               self.locations[row].decode('ascii'), \
+               self.blobs[row].decode('ascii')
+
+    def __getitem__(self, message_id):
+        rows = self.lookup(message_id)
+        if not rows:
+            raise KeyError(message_id)
+        return [self.get_entry(row) for row in rows]
+
+    def get_locations(self):
+        return {location.decode('ascii') for location in self.locations}
+
+    def has_missing_fingerprints(self):
+        return bool(np.any(self.fingerprints == MailIndex.UNKNOWN))
+
+    def get_rows_in_window(self, time_window):
+        """
+        Rows within a time window, costs O(log n + k)
+        """
+        start, end = time_window
+        # Rows are dated to midnight of their day
+        first = start.toordinal() - EPOCH_ORDINAL
+        if start != datetime.datetime.combine(start.date(), datetime.time()):
+            first += 1
+        last = end.toordinal() - EPOCH_ORDINAL
+
+        lo = int(np.searchsorted(self.sorted_days, first, side='left'))
+        hi = int(np.searchsorted(self.sorted_days, last, side='right'))
+
+        return self.by_date[lo:hi]
+
+    def select(self, time_window=None, containers=None):
+        """
+        Message ids within a time window and/or a set of containers
+        """
+        if not time_window:
+            ids = self.get_ids()
+            if containers is None:
+                return set(ids)
+            rows = np.flatnonzero(np.isin(self.containers, list(containers)))
+            return {ids[row] for row in rows}
+
+        rows = self.get_rows_in_window(time_window)
+        if containers is not None:
+            rows = rows[np.isin(self.containers[rows], list(containers))]
+
+        return {self.get_id(row) for row in rows}
+
+    @staticmethod
+    def merge(indices, containers=None):
+        """
+        Merge several indices into one in-memory index
+        :param containers: Optional container numbers of the indices. If not
+               given, rows keep their container.
+        """
+        def concat(columns, dtype):
+            return np.concatenate(list(columns) + [np.zeros(0, dtype=dtype)])
+
+        width = max([index.locations.dtype.itemsize for index in indices] +
+                    [1])
+        location = 'S%u' % width
+
+        hashes = concat((index.hashes for index in indices), np.uint64)
+        days = concat((index.days for index in indices), np.int32)
+        locations = concat((index.locations.astype(location) for
+                            index in indices), location)
+        blob = 'S%u' % max([index.blobs.dtype.itemsize for index in indices] +
+                           [1])
+        blobs = concat((index.blobs.astype(blob) for index in indices), blob)
+        fingerprints = concat((index.fingerprints for index in indices),
+                              np.uint64)
+        if containers is None:
+            merged_containers = concat((index.containers for
+                                        index in indices), np.uint16)
+        else:
+            merged_containers = concat((np.full(len(index), container,
+                                                dtype=np.uint16)
+                                        for index, container in
+                                        zip(indices, containers)), np.uint16)
+        ids = [message_id for index in indices for message_id in
+               index.get_ids()]
+
+        # Stable, so rows of a message id remain in container order
+        order = np.argsort(hashes, kind='stable')
+        merged = MailIndex.from_columns(hashes[order], days[order],
+                                        locations[order], blobs[order],
+                                        fingerprints[order],
+                                        merged_containers[order],
+                                        [ids[row] for row in order])
+        merged.stamp = MailIndex.combine_stamps([index.stamp for
+                                                 index in indices])
+        return merged
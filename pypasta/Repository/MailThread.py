@@ -12,10 +12,8 @@ the COPYING file in the top-level directory.
 
 import os
 import pickle
-import re
 
 from collections import defaultdict
-from email.header import Header
 from anytree import Node, RenderTree
 from itertools import chain
 from logging import getLogger
@@ -25,36 +23,17 @@ from multiprocessing import cpu_count
 
 log = getLogger(__name__[-15:])
 
-ID_REGEX = re.compile(r'(<\S+>)')
 _mbox = None
 
 
-def sanitise_header(message, header):
-    contents = message.get_all(header)
-    ids = set()
-
-    if not contents:
-        return ids
-
-    for content in contents:
-        # special treatment for mails with unknown encoding in their headers
-        if isinstance(content, Header):
-            content = bytearray(content._chunks[0][0], 'utf-8',
-                                'ignore').decode()
-
-        ids |= set(ID_REGEX.findall(content))
-
-    return ids
-
-
 def get_irts(id):
-    messages = _mbox.get_messages(id)
+    records = _mbox.get_header_records(id)
     irt = set()
     ids = set()
 
-    for message in messages:
-        irt |= sanitise_header(message, 'in-reply-to')
-        ids |= sanitise_header(message, 'message-id')
+    for record in records:
+        irt |= record.in_reply_to
+        ids |= record.message_ids
 
     irt -= ids
 
@@ -80,6 +59,10 @@ class MailThread:
 
         log.info('Creating caches for %d mails' % length)
 
+        # Parse missing header records in bulk, before they're queried one by
+        # one
+        self.mbox.update_header_records(parallelise)
+
         global _mbox
         _mbox = self.mbox
 
@@ -135,8 +118,8 @@ class MailThread:
     def pretty_print(self, thread):
         for pre, fill, node in RenderTree(thread):
             if node.name in self.mbox:
-                message = self.mbox.get_messages(node.name)[0]
-                print('%.20s\t\t%s%s' % (message['From'], pre, node.name))
+                record = self.mbox.get_header_records(node.name)[0]
+                print('%.20s\t\t%s%s' % (record['From'], pre, node.name))
             else: # We may have a virtual email
                 print('%.20s\t\t %s' % ('VIRTUAL EMAIL', node.name))
 
@@ -144,14 +127,13 @@ class MailThread:
         # visited tracks visited mails, used to eliminate cycles
         visited.add(message_id)
         # FIXME respect non-unique message ids
-        message = self.mbox.get_messages(message_id)[0]
-        if message is None:
+        record = self.mbox.get_header_records(message_id)[0]
+        if record is None:
             return message_id
 
         # get the parent message-id by walking up references an in-reply-to
         # header. Remove the own message it, as it must not be a reference.
-        references = sanitise_header(message, 'references') | \
-                     sanitise_header(message, 'in-reply-to')
+        references = set(record.references | record.in_reply_to)
         references.discard(message_id)
         if not references:
             return message_id
@@ -11,28 +11,205 @@ the COPYING file in the top-level directory.
 """
 
 import email
+import hashlib
 import os
+import pickle
 import pygit2
 import re
+import threading
 
-from collections import defaultdict
-from datetime import datetime
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
 from email.charset import CHARSETS
+from email.parser import BytesHeaderParser
+from glob import glob
+from itertools import chain, islice
 from logging import getLogger
+from multiprocessing import cpu_count
 from os.path import basename, dirname, exists, isdir, isfile, join
-from subprocess import Popen
+from sys import intern
 
+from .MailHeader import MailHeader
+from .MailIndex import MailIndex, source_stamp
+from .GitPackIndex import GitPackIndex
 from .MailThread import MailThread
-from .MessageDiff import MessageDiff, Signature
-from ..Util import get_commit_hash_range, mail_parse_date, path_convert_relative, \
+from .RawPack import RawPack
+from .MessageDiff import MessageDiff, Signature, intern_signature
+from ..Util import get_commit_hash_range, get_mail_date_stats, \
+    log_mail_date_stats, mail_parse_date, path_convert_relative, \
     read_split_file, write_split_file
 
 log = getLogger(__name__[-15:])
 
+_mbox = None
+
 PATCH_SUBJECT_REGEX = re.compile(r'\[.*?\]:? ?(.*)')
 DIFF_START_REGEX = re.compile(r'^--- \S+/.+$')
 ANNOTATION_REGEX = re.compile(r'^---\s*$')
 
+# The first blank line separates headers and body
+HEADER_END_REGEX = re.compile(rb'\n\r?\n')
+
+# Header lines as understood by the email module
+SIMPLE_HEADER_REGEX = re.compile(rb'[\041-\071\073-\176]+:')
+SIMPLE_ENCODINGS = {'', '7bit', '8bit', 'binary'}
+
+# Threads that read raw mails ahead of their consumer, and how many mails they
+# may read ahead
+RAW_READERS = 8
+RAW_PREFETCH = 256
+
+# Everything PatchMail needs from a simple mail
+SimpleMail = namedtuple('SimpleMail', ['date', 'subject', 'author', 'payload'])
+
+
+def split_headers(raw):
+    """
+    Returns the header part of a raw mail, including the newline of the last
+    header line
+    """
+    match = HEADER_END_REGEX.search(raw)
+    if match:
+        return raw[:match.start() + 1]
+    return raw
+
+
+def format_index_line(message_id, date_str, location, fingerprint, blob):
+    """
+    A line of a text index. Mails outside of public inboxes don't have a blob,
+    '-' takes its place.
+    """
+    return '%s %s %s %s %016x' % (date_str, message_id, location, blob or '-',
+                                  fingerprint)
+
+
+def mail_fingerprint(raw):
+    """
+    Fingerprint of the content of a mail. Lists add headers of their own to
+    the copies they distribute, hence only the body is respected.
+    """
+    match = HEADER_END_REGEX.search(raw)
+    body = raw[match.end():] if match else b''
+    digest = hashlib.blake2b(body.replace(b'\r\n', b'\n'),
+                             digest_size=8).digest()
+    fingerprint = int.from_bytes(digest, 'little')
+    # Don't collide with the markers of the index
+    if fingerprint in (MailIndex.UNKNOWN, MailIndex.UNREADABLE):
+        fingerprint = 1
+    return fingerprint
+
+
+def _simple_charset(content_type):
+    """
+    Returns the charset of a plain text Content-Type, '' if there's no
+    charset, or None if the Content-Type isn't simple
+    """
+    if any(c in content_type for c in '<>\\('):
+        return None
+
+    params = content_type.split(';')
+    if params[0].strip().lower() != 'text/plain':
+        return None
+
+    charset = ''
+    for param in params[1:]:
+        if '=' not in param:
+            return None
+        key, value = param.split('=', 1)
+        key = key.strip().lower()
+        value = value.strip()
+        if '*' in key:
+            return None
+        if '"' in value:
+            if len(value) < 2 or value[0] != '"' or value[-1] != '"' or \
+               '"' in value[1:-1]:
+                return None
+            value = value[1:-1]
+        if key == 'charset' and not charset:
+            charset = value.lower()
+
+    return charset
+
+
+def parse_simple_mail(raw):
+    """
+    Fast path for the vast majority of patch mails: single-part, plain text,
+    non-encoded mails as created by git format-patch. Splits headers and body
+    directly on the bytes, instead of building an email object.
+
+    The result matches what PatchMail gets from the email module (compat32:
+    raw header values of the first occurrence, undecoded encoded words).
+    Returns None for all mails that are not that simple.
+    """
+    headers = list()
+    pos = 0
+    end = len(raw)
+    while True:
+        eol = raw.find(b'\n', pos)
+        # No body at all
+        if eol == -1:
+            return None
+        first = pos == 0
+        line = raw[pos:eol + 1]
+        pos = eol + 1
+
+        if line == b'\n' or line == b'\r\n':
+            break
+
+        # Single carriage returns are line breaks for the email module
+        if b'\r' in line[:-2]:
+            return None
+
+        if line[0] in b' \t':
+            if not headers:
+                return None
+            headers[-1].append(line)
+        elif line.startswith(b'From '):
+            # Only allowed as envelope header in the very first line
+            if not first:
+                return None
+        elif SIMPLE_HEADER_REGEX.match(line):
+            headers.append([line])
+        else:
+            return None
+
+    if pos == end:
+        return None
+
+    values = dict()
+    for lines in headers:
+        try:
+            header = b''.join(lines).decode('ascii')
+        except UnicodeDecodeError:
+            return None
+        name, value = header.split(':', 1)
+        name = name.lower()
+        if name not in values:
+            values[name] = value.lstrip(' \t').rstrip('\r\n')
+
+    if 'date' not in values or 'subject' not in values or \
+       'from' not in values:
+        return None
+
+    charset = _simple_charset(values.get('content-type', 'text/plain'))
+    if charset is None:
+        return None
+    if charset not in CHARSETS:
+        charset = 'ascii'
+
+    if values.get('content-transfer-encoding', '').lower() not in \
+       SIMPLE_ENCODINGS:
+        return None
+
+    payload = raw[pos:].decode(charset, errors='ignore')
+    # The email module would take the complex path
+    if not payload:
+        return None
+
+    return SimpleMail(values['date'], values['subject'], values['from'],
+                      payload)
+
 
 def decode_payload(message):
     payload = message.get_payload(decode=True)
@@ -114,16 +291,25 @@ class PatchMail(MessageDiff):
 
         raise ValueError('Unable to find suitable payload')
 
-    def __init__(self, mail, identifier):
-        # Get informations on the author
-        date = mail_parse_date(mail['Date'], assume_epoch=True)
+    def __init__(self, mail, identifier, keep_raw=False):
+        """
+        :param mail: Either an email object or a SimpleMail
+        """
+        if isinstance(mail, SimpleMail):
+            date = mail_parse_date(mail.date, assume_epoch=True)
+            self.mail_subject = mail.subject
+            author = mail.author
+            payload = mail.payload
+        else:
+            # Get informations on the author
+            date = mail_parse_date(mail['Date'], assume_epoch=True)
 
-        mail, payload = self.extract_patch_mail(mail)
-        self.mail_subject = mail['Subject']
+            mail, payload = self.extract_patch_mail(mail)
+            self.mail_subject = mail['Subject']
+            author = str(mail['From'])
 
-        author = str(mail['From'])
         author_name, author_email = email.utils.parseaddr(author)
-        author = Signature(author_name, author_email, date)
+        author = intern_signature(Signature(author_name, author_email, date))
 
         retval = parse_single_message(payload)
         if retval is None:
@@ -140,7 +326,7 @@ class PatchMail(MessageDiff):
 
         content = msg, annotation, diff
 
-        super(PatchMail, self).__init__(identifier, content, author)
+        super(PatchMail, self).__init__(identifier, content, author, keep_raw)
 
     def format_message(self):
         custom = ['Mail Subject: %s' % self.subject]
@@ -185,148 +371,462 @@ def parse_single_message(mail):
     return None
 
 
-def load_file(filename, must_exist=True):
-    if not isfile(filename) and must_exist is False:
-        return []
+def iter_mbox(f_mbox):
+    """
+    Stream the raw mails of a unix mbox. A mail starts with a 'From ' line
+    at the beginning of the file or after a blank line, and keeps it.
+    """
+    mail = list()
+    blank = True
+
+    with open(f_mbox, 'rb') as f:
+        for line in f:
+            if blank and line.startswith(b'From ') and mail:
+                yield b''.join(mail)
+                mail = list()
+            mail.append(line)
+            blank = line in (b'\n', b'\r\n')
+
+    if mail:
+        yield b''.join(mail)
+
+
+def _raw_mail_date(headers):
+    # Same order as before: Date, NNTP-Posting-Date, and the last Received
+    candidates = [headers.get_all('Date'),
+                  headers.get_all('NNTP-Posting-Date'),
+                  [str(received).rsplit(';', 1)[-1] for received in
+                   headers.get_all('Received') or []]]
+
+    for values in candidates:
+        if not values:
+            continue
+        date = mail_parse_date(str(values[-1]).strip())
+        # Unparseable dates are mapped to the epoch
+        if date.year >= 1970 and date.timestamp() != 0:
+            return date
+
+    return None
 
-    with open(filename) as f:
-        f = f.read().split('\n')
 
-    while len(f) and not f[-1]:
-        f.pop()
+def _raw_mail_message_id(headers):
+    message_id = headers.get('Message-Id')
+    if message_id is None:
+        return None
 
-    f = [tuple(x.split(' ')) for x in f]
+    match = PubInbox.MESSAGE_ID_REGEX.match(str(message_id).strip())
+    if not match or re.search(r"\s|'", match.group(1)):
+        return None
 
-    return f
+    return match.group(1)
 
 
-def process_mailbox_maildir(f_mbox_raw, name, d_mbox, mode):
+INGEST_BATCH_SIZE = 16384
+RAW_MD5_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+_ingest_dest = None
+_ingest_known = None
+_ingest_pack = None
+
+
+def _ingest_mail(mail):
+    """
+    Prepare a raw mail, or a maildir file, for the pack
+    :return: tuple of the index entry (message_id, date_str, md5,
+             fingerprint) and the encoded mail, if it still needs to be
+             packed. None, if the mail is invalid or known.
+    """
+    if isinstance(mail, str):
+        with open(mail, 'rb') as f:
+            mail = f.read()
+
+    headers = BytesHeaderParser().parsebytes(split_headers(mail))
+    message_id = _raw_mail_message_id(headers)
+    if message_id is None:
+        return None
+
+    # Known mails may be dated differently, older indices used local time
+    md5 = hashlib.md5(mail).hexdigest()
+    if (message_id, md5) in _ingest_known:
+        return None
+
+    date = _raw_mail_date(headers)
+    if date is None:
+        log.warning('Unable to parse date of %s' % message_id)
+        return None
+
+    date_str = date.strftime('%04Y/%m/%d')
+    entry = message_id, date_str, md5, mail_fingerprint(mail)
+    # Unpacked mails below <d_mbox>/raw/YYYY/MM/DD/<md5> remain valid
+    if md5 in _ingest_pack or isfile(join(_ingest_dest, date_str, md5)):
+        return entry, None
+
+    return entry, RawPack.encode(mail)
+
+
+def process_mailbox_maildir(f_mbox_raw, name, d_mbox, mode, pack,
+                            cpu_factor=1):
     """
+    Pack the mails of an mbox or a maildir, and index them
     :param f_mbox_raw: filename of the mbox/maildir
     :param name: index name
     :param d_mbox: destination directory
     :param mode: can either be 'raw'
+    :param pack: RawPack that receives the mails
+    :param cpu_factor: Mails are ingested in this process if it leaves a
+           single CPU, e.g., if the caller runs in a worker itself
     """
+    global _ingest_dest, _ingest_known, _ingest_pack
+
     if not exists(f_mbox_raw):
         log.error('no such file or directory: %s' % f_mbox_raw)
         quit(-1)
 
-    p = Popen(['./process_mailbox_maildir.sh', mode, name, d_mbox, f_mbox_raw],
-              cwd=join(os.getcwd(), 'tools'))
-    if p.wait():
-        log.error('Mail processor failed!')
-        quit(-1)
-    log.info('  ↪ done')
+    f_index = join(d_mbox, 'index', '%s.%s' % (mode, name))
+    index = set()
+    if isfile(f_index):
+        with open(f_index, 'r', errors='surrogateescape') as f:
+            index = {line for line in f.read().split('\n') if line}
+
+    # Mails are sorted in again on every update. Skip known ones.
+    _ingest_dest = join(d_mbox, mode)
+    _ingest_known = {tuple(line.split()[1:3]) for line in index}
+    _ingest_pack = pack
+
+    if isdir(f_mbox_raw):
+        mails = iter([join(root, filename) for root, _, filenames in
+                      os.walk(f_mbox_raw) for filename in filenames])
+    else:
+        mails = iter_mbox(f_mbox_raw)
+
+    num_cpus = int(cpu_count() * cpu_factor)
+    executor = None
+    if num_cpus > 1:
+        executor = ProcessPoolExecutor(max_workers=num_cpus)
+
+    entries = list()
+    # Don't read the whole mbox ahead of the workers
+    while True:
+        batch = list(islice(mails, INGEST_BATCH_SIZE))
+        if not batch:
+            break
+        if executor:
+            results = executor.map(_ingest_mail, batch, chunksize=64)
+        else:
+            results = map(_ingest_mail, batch)
+        results = [result for result in results if result]
+        pack.append((entry[2], *encoded) for entry, encoded in results
+                    if encoded)
+        entries += [entry for entry, _ in results]
 
+    if executor:
+        executor.shutdown()
+    _ingest_known = None
+    _ingest_pack = None
 
-class MailContainer:
-    @staticmethod
-    def load_index(f_index):
-        index = dict()
-        entries = load_file(f_index, must_exist=False)
+    index |= {format_index_line(*entry, '') for entry in entries}
+    os.makedirs(dirname(f_index), exist_ok=True)
+    with open(f_index, 'w', errors='surrogateescape') as f:
+        f.write(''.join('%s\n' % line for line in sorted(index)))
 
-        for entry in entries:
-            date, message_id, location = entry[0:3]
-            dtime = datetime.strptime(date, '%Y/%m/%d')
+    log.info('  ↪ done, %d new mails' % len(entries))
 
-            if message_id not in index:
-                index[message_id] = list()
 
-            index[message_id].append((dtime, date, location))
+def _encode_raw_file(filename):
+    with open(filename, 'rb') as f:
+        return (basename(filename), *RawPack.encode(f.read()))
 
-        return index
 
-    def write_index(self, f_index):
-        index = list()
-        for message_id, candidates in self.index.items():
-            for entry in candidates:
-                format_date = entry[1]
-                line = '%s %s ' % (format_date, message_id)
-                line += entry[2]
-                index.append(line)
-        index.sort()
+def pack_raw_directory(d_raw, pack, remove=True, cpu_factor=1):
+    """
+    Move mails stored as d_raw/YYYY/MM/DD/<md5> into pack
+    """
+    filenames = [filename for filename in
+                 glob(join(d_raw, '[0-9]' * 4, '[0-9]' * 2, '[0-9]' * 2, '*'))
+                 if RAW_MD5_REGEX.match(basename(filename))]
+    log.info('Packing %d raw mails' % len(filenames))
+
+    num_cpus = max(1, int(cpu_count() * cpu_factor))
+    packed = 0
+    with ProcessPoolExecutor(max_workers=num_cpus) as executor:
+        for start in range(0, len(filenames), INGEST_BATCH_SIZE):
+            batch = filenames[start:start + INGEST_BATCH_SIZE]
+            batch = [filename for filename in batch if
+                     basename(filename) not in pack]
+            packed += pack.append(executor.map(_encode_raw_file, batch,
+                                               chunksize=64))
+
+    # The pack is synced to disk, the files are no longer needed
+    if remove:
+        for filename in filenames:
+            os.remove(filename)
+        for d_day in sorted({dirname(filename) for filename in filenames},
+                            reverse=True):
+            for directory in (d_day, dirname(d_day), dirname(dirname(d_day))):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+
+    log.info('  ↪ packed %d mails into %s' % (packed, pack.f_pack))
+
+
+class MailContainer:
+    @staticmethod
+    def load_index(f_index, f_index_bin):
+        return MailIndex.load(f_index, f_index_bin)
+
+    @staticmethod
+    def append_index(f_index, entries):
+        """
+        Append new entries to the text index
+        :param entries: list of tuples (message_id, date_str, location,
+               fingerprint, blob)
+        """
+        if not entries:
+            return
 
         d_index = dirname(f_index)
         os.makedirs(d_index, exist_ok=True)
-        with open(f_index, 'w') as f:
-            f.write('\n'.join(index) + '\n')
+        with open(f_index, 'a', errors='surrogateescape') as f:
+            f.write(''.join('%s\n' % format_index_line(*entry) for
+                            entry in entries))
+
+    def get_blob_id(self, location):
+        return None
+
+    def backfill_index(self, f_index):
+        """
+        One-time migration of text indices that don't record blobs or
+        fingerprints yet
+        """
+        log.info('Fingerprinting mails of %s' % self.listaddr)
+        lines = list()
+        unreadable = 0
+        with open(f_index, 'r', errors='surrogateescape') as f:
+            for line in f:
+                entry = line.split()
+                if len(entry) in (3, 4):
+                    date_str, message_id, location = entry[0:3]
+                    blob = entry[3] if len(entry) == 4 else \
+                        self.get_blob_id(location)
+                    blob = '' if blob in (None, '-') else blob
+                    try:
+                        raw = self.get_raw(date_str, location, blob)
+                    except (FileNotFoundError, KeyError):
+                        raw = None
+                    if raw is None:
+                        # Don't try again on every sync
+                        fingerprint = MailIndex.UNREADABLE
+                        unreadable += 1
+                    else:
+                        fingerprint = mail_fingerprint(raw)
+                    line = format_index_line(message_id, date_str, location,
+                                             fingerprint, blob)
+                lines.append(line.rstrip('\n'))
+
+        if unreadable:
+            log.warning('  ↪ unable to read %d mails of %s' %
+                        (unreadable, self.listaddr))
+
+        f_tmp = f_index + '.tmp'
+        with open(f_tmp, 'w', errors='surrogateescape') as f:
+            f.write(''.join('%s\n' % line for line in lines))
+        os.replace(f_tmp, f_index)
 
     def get_ids(self, time_window=None):
         if time_window:
-            return {x[0] for x in self.index.items() if
-                    any(map(
-                        lambda date: time_window[0] <= date <= time_window[1],
-                        [y[0] for y in x[1]]))}
+            return self.index.select(time_window)
 
-        return set(self.index.keys())
+        return set(self.index.get_ids())
 
     def __contains__(self, message_id):
         return message_id in self.index
 
+    def __getitem__(self, message_id):
+        return self.read_raws([entry[1:] for entry in self.index[message_id]])
+
+    def get_raw(self, date_str, location, blob):
+        raise NotImplementedError
+
+    def get_raw_header(self, date_str, location, blob):
+        return split_headers(self.get_raw(date_str, location, blob))
+
+    def get_raw_headers(self, message_id):
+        return [self.get_raw_header(*entry[1:]) for entry in
+                self.index[message_id]]
+
+    def prepare_reads(self):
+        """
+        Set up everything that is lazily initialised before reads, as they
+        may run in several threads
+        """
+        pass
+
+    def disk_order(self, entries):
+        """
+        :return: positions of entries, in the order they are stored
+        """
+        return range(len(entries))
+
+    def read_raws(self, entries):
+        """
+        Read several mails in the order they are stored
+        :param entries: list of tuples (date_str, location, blob)
+        :return: list of raw mails, in the order of entries
+        """
+        raws = [None] * len(entries)
+        for pos in self.disk_order(entries):
+            raws[pos] = self.get_raw(*entries[pos])
+
+        return raws
+
+    def reopen(self):
+        pass
+
 
 class PubInbox(MailContainer):
     MESSAGE_ID_REGEX = re.compile(r'.*(<.*>).*')
 
-    def __init__(self, listaddr, shard, d_repo, f_index):
+    def __init__(self, listaddr, shard, d_repo, f_index, f_index_bin):
         self.listaddr = listaddr
         self.f_index = f_index
+        self.f_index_bin = f_index_bin
+        # The last indexed commit, and the size of the text index back then
+        self.f_tip = f_index_bin + '.tip'
         self.d_repo = d_repo
 
         self.repo = pygit2.Repository(d_repo)
-        self.index = self.load_index(self.f_index)
+        # Handles for reads from other threads, see thread_repo()
+        self.local = threading.local()
+        self.pack_index = None
+        self.load()
 
         log.info('  ↪ loaded mail index for %s (shard %u): found %d mails' %
                  (listaddr, shard, len(self.index)))
 
-    def get_blob(self, commit):
-        tree = self.repo[commit].tree
+    def load(self):
+        self.index = self.load_index(self.f_index, self.f_index_bin)
+
+    def reopen(self):
+        self.repo = pygit2.Repository(self.d_repo)
+        self.local = threading.local()
+        self.pack_index = None
+
+    def thread_repo(self):
+        """
+        libgit2 handles must not be shared across threads. Mails are read
+        through a handle of the current thread.
+        """
+        repo = getattr(self.local, 'repo', None)
+        if repo is None:
+            repo = self.local.repo = pygit2.Repository(self.d_repo)
+        return repo
+
+    def prepare_reads(self):
+        if self.pack_index is None:
+            self.pack_index = GitPackIndex(self.d_repo)
+
+    def get_blob_id(self, commit):
+        tree = self.thread_repo()[commit].tree
 
         if 'm' in tree:
-            return tree['m'].data
+            return str(tree['m'].id)
 
         # Some spam mails use 'd'. Don't ignore them, for the sake of
         # completeness.
         if 'd' in tree:
-            return tree['d'].data
+            return str(tree['d'].id)
 
         return None
 
-    def get_mail_by_commit(self, commit):
-        blob = self.get_blob(commit)
+    def get_blob(self, commit, blob=None):
+        """
+        Reading a known blob directly saves resolving the commit and its tree
+        """
+        if not blob:
+            blob = self.get_blob_id(commit)
+            if not blob:
+                return None
+
+        return self.thread_repo()[blob].data
+
+    def get_mail_by_commit(self, commit, blob=None):
+        blob = self.get_blob(commit, blob)
         if not blob:
             return None
 
         return email.message_from_bytes(blob)
 
     def get_mails_by_message_id(self, message_id):
-        commits = self.get_hashes(message_id)
-        return [self.get_mail_by_commit(commit) for commit in commits]
+        return [self.get_mail_by_commit(commit, blob) for _, _, commit, blob
+                in self.index[message_id]]
 
     def get_hashes(self, message_id):
         return [x[2] for x in self.index[message_id]]
 
-    def __getitem__(self, message_id):
-        commits = self.get_hashes(message_id)
-        return [self.get_blob(commit) for commit in commits]
+    def get_raw(self, date_str, location, blob):
+        return self.get_blob(location, blob)
 
-    def update(self):
-        log.info('Update list %s' % self.listaddr)
-        self.repo = pygit2.Repository(self.d_repo)
+    def disk_order(self, entries):
+        self.prepare_reads()
+        return self.pack_index.order([blob or commit for _, commit, blob in
+                                      entries])
 
-        known_hashes = set()
-        for entry in self.index.values():
-            known_hashes |= {x[2] for x in entry}
+    def get_tip(self, head):
+        """
+        The last indexed commit, if it still describes the text index and if
+        head descends from it
+        """
+        try:
+            with open(self.f_tip) as f:
+                tip, size = f.read().split()
+        except (FileNotFoundError, ValueError):
+            return None
 
-        hashes = set(get_commit_hash_range(self.d_repo, 'HEAD'))
+        if int(size) != source_stamp(self.f_index)[0] or tip not in self.repo:
+            return None
+
+        # The history of the inbox was rewritten
+        if tip != head and not self.repo.descendant_of(head, tip):
+            return None
 
-        hashes = hashes - known_hashes
+        return tip
+
+    def set_tip(self, tip):
+        with open(self.f_tip, 'w') as f:
+            f.write('%s %d\n' % (tip, source_stamp(self.f_index)[0]))
+
+    def update(self, cpu_factor=1):
+        log.info('Update list %s' % self.listaddr)
+        self.repo = pygit2.Repository(self.d_repo)
+        self.local = threading.local()
+        self.pack_index = None
+        head = str(self.repo.revparse_single('HEAD').id)
+
+        tip = self.get_tip(head)
+        if self.index.has_missing_fingerprints():
+            self.backfill_index(self.f_index)
+            if tip:
+                self.set_tip(tip)
+        if tip:
+            hashes = get_commit_hash_range(self.repo, '%s..%s' % (tip, head))
+        else:
+            # Unknown or stale tip: compare the whole shard against the index
+            known_hashes = self.index.get_locations()
+            hashes = [hash for hash in get_commit_hash_range(self.repo, head)
+                      if hash not in known_hashes]
         log.info('Updating %d emails' % len(hashes))
 
-        for hash in hashes:
-            mail = self.get_mail_by_commit(hash)
-            if not mail:
+        entries = list()
+        # Oldest first, so the text index grows chronologically
+        for hash in reversed(hashes):
+            blob = self.get_blob_id(hash)
+            if not blob:
                 log.warning('No email behind commit %s' % hash)
                 continue
+            raw = self.get_blob(hash, blob)
+            mail = email.message_from_bytes(raw)
 
             # There are broken mails that may contain multiple Message-IDs.
             # Hence, get all Message-IDs and search for the sanest one
@@ -356,60 +856,128 @@ class PubInbox(MailContainer):
                 continue
 
             format_date = date.strftime('%04Y/%m/%d')
+            entries.append((id, format_date, hash, mail_fingerprint(raw),
+                            blob))
 
-            if id not in self.index:
-                self.index[id] = list()
-            self.index[id].append((date, format_date, hash))
-
-        self.write_index(self.f_index)
+        self.append_index(self.f_index, entries)
+        self.load()
+        self.set_tip(head)
 
 
 class MboxRaw(MailContainer):
-    def __init__(self, listaddr, d_mbox, d_index, f_mboxes_raw):
+    def __init__(self, listaddr, d_mbox, d_index, d_index_bin, pack,
+                 f_mboxes_raw):
         self.listaddr = listaddr
         self.f_mboxes_raw = f_mboxes_raw
         self.d_mbox = d_mbox
         self.d_mbox_raw = join(d_mbox, 'raw')
-        self.index = defaultdict(list)
+        self.pack = pack
 
         self.mboxes = list()
+        self.f_indices = list()
         for f_mbox_raw in f_mboxes_raw:
             f_mbox_raw = path_convert_relative(join(d_mbox, 'raw'), f_mbox_raw)
             mbox_id = '%s.%s' % (listaddr, basename(f_mbox_raw))
             f_mbox_index = join(d_index, 'raw.%s' % mbox_id)
-            index = self.load_index(f_mbox_index)
-            for id, desc in index.items():
-                self.index[id] += desc
-
-            log.info('  ↪ loaded mail index for %s: found %d mails' % (listaddr, len(index)))
+            f_mbox_index_bin = join(d_index_bin, 'raw.%s' % mbox_id)
             self.mboxes.append((f_mbox_raw, mbox_id))
+            self.f_indices.append((f_mbox_index, f_mbox_index_bin))
+
+        self.load()
+        log.info('  ↪ loaded mail index for %s: found %d mails' % (listaddr, len(self.index)))
+
+    def load(self):
+        indices = [self.load_index(f_index, f_index_bin) for
+                   f_index, f_index_bin in self.f_indices]
+
+        if len(indices) == 1:
+            self.index = indices[0]
+        else:
+            self.index = MailIndex.merge(indices)
+
+    def update(self, cpu_factor=1):
+        if self.index.has_missing_fingerprints():
+            for f_index, _ in self.f_indices:
+                if isfile(f_index):
+                    self.backfill_index(f_index)
 
-    def update(self):
         for f_mbox_raw, mbox_id in self.mboxes:
             log.info('Processing raw mailbox %s' % mbox_id)
-            process_mailbox_maildir(f_mbox_raw, mbox_id, self.d_mbox, 'raw')
+            process_mailbox_maildir(f_mbox_raw, mbox_id, self.d_mbox, 'raw',
+                                    self.pack, cpu_factor)
 
-    def __getitem__(self, message_id):
-        ret = list()
+    def reopen(self):
+        self.pack.reopen()
 
-        for _, date_str, md5 in self.index[message_id]:
-            filename = join(self.d_mbox_raw, date_str, md5)
-            with open(filename, 'rb') as f:
-                ret.append(f.read())
+    def get_raw(self, date_str, md5, blob=''):
+        raw = self.pack.get(md5)
+        if raw is not None:
+            return raw
 
-        return ret
+        filename = join(self.d_mbox_raw, date_str, md5)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def get_raw_header(self, date_str, md5, blob=''):
+        if md5 in self.pack:
+            return split_headers(self.pack.get(md5))
+
+        # Don't read bodies, they may carry huge attachments
+        filename = join(self.d_mbox_raw, date_str, md5)
+        headers = list()
+        with open(filename, 'rb') as f:
+            for line in f:
+                if line == b'\n' or line == b'\r\n':
+                    break
+                headers.append(line)
+
+        return b''.join(headers)
+
+    def disk_order(self, entries):
+        return self.pack.order([md5 for _, md5, _ in entries])
+
+
+def _init_worker():
+    # libgit2 handles must not be shared across processes
+    _mbox.reopen()
+
+
+def _update_container(num):
+    # Containers are already updated in parallel, don't nest pools
+    stats = get_mail_date_stats()
+    _mbox.mboxes[num].update(cpu_factor=0)
+    # Workers inherit the counters of the parent, report only their own share
+    return num, {key: value - stats[key] for key, value in
+                 get_mail_date_stats().items()}
+
+
+def _header_records(message_ids):
+    parser = BytesHeaderParser()
+    ret = list()
+    for message_id, headers in _mbox.iter_raws(message_ids, headers=True):
+        records = tuple(MailHeader(parser.parsebytes(header)) for
+                        header in headers)
+        ret.append((_mbox.header_record_key(message_id),
+                    *RawPack.encode(pickle.dumps(records,
+                                                 pickle.HIGHEST_PROTOCOL))))
+    return ret
 
 
 class Mbox:
     def __init__(self, config):
         self.threads = None
+        self.header_records = None
         self.f_mail_thread_cache = config.f_mail_thread_cache
-        self.message_id_to_lists = defaultdict(set)
         self.lists = set()
         self.d_mbox = config.d_mbox
         self.f_invalid = join(self.d_mbox, 'invalid')
+        self.f_header_records = join(self.d_mbox, 'headers.pack')
         self.d_index = join(self.d_mbox, 'index')
+        # Binary indices are derived from the text indices, and kept apart
+        # from them
+        self.d_index_bin = join(self.d_mbox, 'index.bin')
         self.mboxes = list()
+        self.raw_pack = None
 
         log.info('Loading mailbox subsystem')
 
@@ -426,29 +994,35 @@ class Mbox:
 
         if len(config.mbox_raw):
             log.info('Loading raw mailboxes...')
+            self.raw_pack = RawPack(join(self.d_mbox, 'raw.pack'))
         for host, listdesc in config.mbox_raw.items():
             for listname, f_mboxes_raw in listdesc.items():
-                listaddr = '%s@%s' % (listname, host)
+                listaddr = intern('%s@%s' % (listname, host))
                 self.lists.add(listaddr)
-                mbox_raw = MboxRaw(listaddr, self.d_mbox, self.d_index, f_mboxes_raw)
+                mbox_raw = MboxRaw(listaddr, self.d_mbox, self.d_index,
+                                   self.d_index_bin, self.raw_pack,
+                                   f_mboxes_raw)
                 self.mboxes.append(mbox_raw)
 
         if len(config.mbox_pubin):
             log.info('Loading public inboxes')
         for host, mailinglists in config.mbox_pubin.items():
             for mailinglist in mailinglists:
-                listaddr = '%s@%s' % (mailinglist, host)
+                listaddr = intern('%s@%s' % (mailinglist, host))
                 self.lists.add(listaddr)
 
                 shard = 0
                 while True:
                     d_repo = join(config.d_mbox, 'pubin', host, mailinglist,
                                   '%u.git' % shard)
-                    f_index = join(config.d_mbox, 'index', 'pubin', host,
+                    f_index = join(self.d_index, 'pubin', host,
                                    mailinglist, '%u' % shard)
+                    f_index_bin = join(self.d_index_bin, 'pubin', host,
+                                       mailinglist, '%u' % shard)
 
                     if isdir(d_repo):
-                        inbox = PubInbox(listaddr, shard, d_repo, f_index)
+                        inbox = PubInbox(listaddr, shard, d_repo, f_index,
+                                         f_index_bin)
                         self.mboxes.append(inbox)
                     else:
                         if shard == 0:
@@ -459,9 +1033,16 @@ class Mbox:
 
                     shard += 1
 
-        for mbox in self.mboxes:
-            for message_id in mbox.get_ids():
-                self.message_id_to_lists[message_id].add(mbox.listaddr)
+        self.load_merged_index()
+
+    def load_merged_index(self):
+        # One lookup in the merged index resolves a message id to all its
+        # copies in all containers
+        self.index = MailIndex.load_merged(
+            join(self.d_index_bin, 'merged'),
+            [(mbox.listaddr, mbox.index) for mbox in self.mboxes])
+        log.info('  ↪ merged mail index: %d mails in %d containers' %
+                 (len(self.index), len(self.mboxes)))
 
     def load_threads(self):
         if not self.threads:
@@ -469,22 +1050,40 @@ class Mbox:
         return self.threads
 
     def __contains__(self, message_id):
-        for mbox in self.mboxes:
-            if message_id in mbox:
-                return True
+        return message_id in self.index
 
-        return False
+    def lookup(self, message_id, duplicates=False):
+        """
+        :param duplicates: Include copies whose content matches an earlier
+               copy, e.g., of cross-posted mails
+        :return: list of tuples (container, date_str, location, blob) of the
+                 copies of a mail
+        """
+        ret = list()
+        for row in self.index.lookup(message_id, duplicates):
+            _, date_str, location, blob = self.index.get_entry(row)
+            ret.append((self.mboxes[self.index.get_container(row)],
+                        date_str, location, blob))
+
+        return ret
 
     def __getitem__(self, message_id):
-        messages = self.get_messages(message_id)
+        return self.get_patch(message_id)
+
+    def get_patch(self, message_id, keep_raw=False, raws=None):
+        if raws is None:
+            raws = self.get_raws(message_id)
         exception = None
 
-        if len(messages) == 0:
+        if len(raws) == 0:
             raise KeyError('Message not found')
 
-        for message in messages:
+        for raw in raws:
             try:
-                patch = PatchMail(message, message_id)
+                message = parse_simple_mail(raw)
+                if message is None:
+                    message = email.message_from_bytes(raw)
+                patch = PatchMail(message, message_id, keep_raw)
                 return patch
             except Exception as e:
                 exception = e
@@ -496,35 +1095,225 @@ class Mbox:
 
         return [email.message_from_bytes(raw) for raw in raws]
 
+    def get_headers(self, message_id):
+        """
+        Like get_messages, but only headers are parsed. Bodies are empty.
+        """
+        parser = BytesHeaderParser()
+
+        return [parser.parsebytes(header) for header in
+                self.get_raw_headers(message_id)]
+
+    def load_header_records(self):
+        """
+        Header records are stored in a pack of their own, and only read on
+        demand
+        """
+        if self.header_records is not None:
+            return
+
+        self.header_records = RawPack(self.f_header_records)
+        log.info('  ↪ found %d stored header records' %
+                 len(self.header_records))
+
+    def header_record_key(self, message_id):
+        """
+        Key of the stored header records of a message id. It covers all
+        copies the records are parsed from: once the index gains a copy, the
+        records are parsed again.
+        """
+        digest = hashlib.blake2b(message_id.encode('utf-8', 'surrogateescape'),
+                                 digest_size=16)
+        for location in sorted(location for _, _, location, _ in
+                               self.lookup(message_id)):
+            digest.update(b' ' + location.encode('ascii'))
+        return digest.hexdigest()
+
+    def get_header_records(self, message_id):
+        """
+        Parsed headers of all mails with a given message id. Stored records
+        are preferred, they are only computed if they're missing or outdated.
+        """
+        self.load_header_records()
+        data = self.header_records.get(self.header_record_key(message_id))
+        if data is not None:
+            return pickle.loads(data)
+
+        return tuple(MailHeader(message) for message in
+                     self.get_headers(message_id))
+
+    def update_header_records(self, parallelise=True):
+        global _mbox
+
+        self.load_header_records()
+        missing = [message_id for message_id in
+                   self.get_ids(allow_invalid=True) if
+                   self.header_record_key(message_id) not in
+                   self.header_records]
+        if not missing:
+            return
+
+        log.info('Parsing headers of %d new mails' % len(missing))
+        # Workers take consecutive mails, as they are stored
+        missing = self.sort_by_location(missing)
+        chunks = [missing[i:i + 1000] for i in range(0, len(missing), 1000)]
+        _mbox = self
+        # Outdated records remain in the pack, but they're never read again
+        if parallelise:
+            with ProcessPoolExecutor(max_workers=cpu_count(),
+                                     initializer=_init_worker) as executor:
+                self.header_records.append(chain.from_iterable(
+                    executor.map(_header_records, chunks)))
+        else:
+            self.header_records.append(chain.from_iterable(
+                map(_header_records, chunks)))
+        _mbox = None
+
     def get_raws(self, message_id):
-        raws = list()
+        copies = self.lookup(message_id)
+        raws = [None] * len(copies)
+
+        # Copies in the same container are read in the order they are stored
+        containers = dict()
+        for pos, (mbox, date_str, location, blob) in enumerate(copies):
+            containers.setdefault(mbox, list()).append(
+                (pos, (date_str, location, blob)))
+        for mbox, entries in containers.items():
+            positions, entries = zip(*entries)
+            for pos, raw in zip(positions, mbox.read_raws(entries)):
+                raws[pos] = raw
+
+        return raws
+
+    def get_raw_headers(self, message_id):
+        return [mbox.get_raw_header(date_str, location, blob) for
+                mbox, date_str, location, blob in self.lookup(message_id)]
+
+    def sort_by_location(self, message_ids):
+        """
+        Order message ids by the location of their mails on disk. Mails are
+        grouped by container, unknown message ids come last.
+        """
+        message_ids = list(message_ids)
+        containers = dict()
+        for pos, message_id in enumerate(message_ids):
+            rows = self.index.lookup(message_id)
+            if not rows:
+                containers.setdefault(None, list()).append((pos, None))
+                continue
+            row = rows[0]
+            containers.setdefault(self.index.get_container(row), list()).\
+                append((pos, self.index.get_entry(row)[1:]))
+
+        order = list()
+        for container in sorted(containers, key=lambda x: (x is None, x)):
+            positions, entries = zip(*containers[container])
+            if container is None:
+                order.extend(positions)
+                continue
+            order.extend(positions[pos] for pos in
+                         self.mboxes[container].disk_order(entries))
+
+        return [message_ids[pos] for pos in order]
+
+    def iter_raws(self, message_ids, headers=False):
+        """
+        Read the raw mails of many message ids. Mails are read in the order
+        they are stored by a pool of threads, ahead of the consumer.
+        :param headers: Only read the headers of the mails
+        :return: iterator of tuples (message_id, raws), in on-disk order
+        """
+        read = self.get_raw_headers if headers else self.get_raws
+        pending = deque()
 
         for mbox in self.mboxes:
-            if message_id in mbox:
-                raws += mbox[message_id]
+            mbox.prepare_reads()
 
-        return raws
+        with ThreadPoolExecutor(max_workers=RAW_READERS) as executor:
+            for message_id in self.sort_by_location(message_ids):
+                pending.append((message_id, executor.submit(read, message_id)))
+                if len(pending) < RAW_PREFETCH:
+                    continue
+                message_id, future = pending.popleft()
+                yield message_id, future.result()
+
+            while pending:
+                message_id, future = pending.popleft()
+                yield message_id, future.result()
 
     def get_ids(self, time_window=None, allow_invalid=False, lists=None):
-        ids = set()
+        containers = None
+        if lists:
+            containers = [i for i, mbox in enumerate(self.mboxes) if
+                          mbox.listaddr in lists]
 
-        for mbox in self.mboxes:
-            ids |= mbox.get_ids(time_window)
+        ids = self.index.select(time_window, containers)
 
         if not allow_invalid:
             ids = ids - self.invalid
 
-        if lists:
-            ids = {id for id in ids if len(self.get_lists(id) & lists)}
-
         return ids
 
-    def update(self):
+    def update(self, cpu_factor=1):
+        """
+        Update all containers. Shards and lists are independent of each
+        other, and are updated in parallel.
+        """
+        global _mbox
+
+        num_cpus = min(int(cpu_count() * cpu_factor), len(self.mboxes))
+        if num_cpus <= 1:
+            for mbox in self.mboxes:
+                mbox.update(cpu_factor)
+            log_mail_date_stats()
+            self.load_merged_index()
+            return
+
+        log.info('Updating %d mail containers on %d CPUs' %
+                 (len(self.mboxes), num_cpus))
+        _mbox = self
+        stats = Counter()
+        with ProcessPoolExecutor(max_workers=num_cpus,
+                                 initializer=_init_worker) as executor:
+            futures = [executor.submit(_update_container, num) for num in
+                       range(len(self.mboxes))]
+            for future in as_completed(futures):
+                num, this_stats = future.result()
+                stats.update(this_stats)
+                mbox = self.mboxes[num]
+                known = len(mbox.index)
+                # The worker wrote the new entries, pick them up
+                mbox.load()
+                log.info('  ↪ %s: %d new mails' %
+                         (mbox.listaddr, len(mbox.index) - known))
+        _mbox = None
+        log_mail_date_stats(stats)
+
+        # Workers appended to the pack
+        if self.raw_pack is not None:
+            self.raw_pack.load()
+        self.load_merged_index()
+
+    def reopen(self):
         for mbox in self.mboxes:
-            mbox.update()
+            mbox.reopen()
+        if self.header_records is not None:
+            self.header_records.reopen()
+
+    def pack_raw(self, remove=True):
+        """
+        Migrate unpacked raw mails into the pack
+        """
+        if self.raw_pack is None:
+            log.info('No raw mailboxes configured')
+            return
+
+        pack_raw_directory(join(self.d_mbox, 'raw'), self.raw_pack, remove)
 
     def get_lists(self, message_id):
-        return self.message_id_to_lists[message_id]
+        # Duplicates still tell on which lists a mail appeared
+        return {self.mboxes[self.index.get_container(row)].listaddr for
+                row in self.index.lookup(message_id)}
 
     def invalidate(self, invalid):
         self.invalid |= set(invalid)
@@ -11,22 +11,87 @@ the COPYING file in the top-level directory.
 """
 import re
 from collections import defaultdict
+from sys import intern
 
-from .Patch import Diff
+from .Patch import parse_diff
 from ..Util import replace_umlauts
 
+# Flyweight table: identical signatures share a single object
+_signatures = dict()
+
+
+def intern_signature(signature):
+    # Identical points in time with different offsets compare equal, so
+    # respect the offset
+    date = signature.date
+    key = signature.name, signature.email, date, date.utcoffset()
+    return _signatures.setdefault(key, signature)
+
+
+def clear_signatures():
+    _signatures.clear()
+
+
+def _unpickle_signature(name, email, date):
+    signature = Signature.__new__(Signature)
+    signature.name = intern(name)
+    signature.email = intern(email)
+    signature.date = date
+    return intern_signature(signature)
+
 
 class Signature:
+    __slots__ = ('name', 'email', 'date')
+
     def __init__(self, name, email, date):
-        self.name = replace_umlauts(name).lower()
-        self.email = email.lower()
+        self.name = intern(replace_umlauts(name).lower())
+        self.email = intern(email.lower())
         self.date = date
 
+    def __reduce__(self):
+        # Route unpickling through the flyweight table
+        return _unpickle_signature, (self.name, self.email, self.date)
+
+
+class Header:
+    """
+    The cheap tier of a MessageDiff: everything but the message and the diff.
+    Most consumers only need dates, authors or affected files, and headers
+    are much cheaper to load than fully parsed commits or mails.
+    """
+    __slots__ = ('identifier', 'author', 'committer', 'subject', 'affected',
+                 'lines', 'is_revert', 'digest')
+
+    def __init__(self, identifier, author, committer, subject, affected,
+                 lines, is_revert, digest):
+        self.identifier = identifier
+        self.author = author
+        # None for mails
+        self.committer = committer
+        self.subject = subject
+        self.affected = affected
+        self.lines = lines
+        self.is_revert = is_revert
+        # Digest of the diff in the diff store, None if it isn't shared
+        self.digest = digest
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        # Caches of older versions lack the digest
+        self.digest = None
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+        self.affected = frozenset(intern(x) for x in self.affected)
+
 
 class MessageDiff:
     """
     An abstract class that consists of a message, and a diff.
     """
+    # Only commits have a committer
+    committer = None
 
     # Tags used in Linux kernel mailing lists
     VALID_TAGS = (r'^('
@@ -78,7 +143,7 @@ class MessageDiff:
     TAG_REGEX = re.compile(r'^%s\s*:\s*(.*)$' % VALID_TAGS, re.IGNORECASE)
     LINUX_ML_PREFIX = re.compile(r'https?://(lore|lkml).kernel.org')
 
-    def __init__(self, identifier, content, author):
+    def __init__(self, identifier, content, author, keep_raw=False):
         self.identifier = identifier
         self.author = author
 
@@ -114,7 +179,7 @@ class MessageDiff:
         self.is_revert = any('revert' in x.lower() for x in self.raw_message)
 
         # do the tricky part: parse the diff
-        self.diff = Diff(diff)
+        self.diff = parse_diff(diff, keep_raw=keep_raw)
 
     def format_message(self, custom):
         type = 'Commit:    ' if self.identifier[0] != '<' else 'Message-ID:'
@@ -130,3 +195,10 @@ class MessageDiff:
     @property
     def subject(self):
         return self.message[0]
+
+    @property
+    def header(self):
+        subject = self.subject if self.message else ''
+        return Header(self.identifier, self.author, self.committer,
+                      subject, self.diff.affected, self.diff.lines,
+                      self.is_revert, self.diff.digest)
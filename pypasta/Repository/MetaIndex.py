@@ -0,0 +1,250 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import numpy as np
+import os
+import pickle
+
+from logging import getLogger
+from os.path import dirname
+from sys import intern
+
+log = getLogger(__name__[-15:])
+
+
+class MetaIndex:
+    """
+    Columnar metadata of commits and mails. Analyses that only need dates,
+    authors, committers, lists or line counts can run from this index
+    without loading any commit cache.
+
+    Dates are stored as seconds since the epoch, together with their UTC
+    offset in minutes. Authors and committers are indices into a table of
+    people, mails don't have a committer (NONE). List membership is stored
+    in CSR form: the lists of row i are lists[list_idx[list_ptr[i]:list_ptr[i+1]]].
+    """
+    NONE = -1
+    VERSION = 1
+
+    def __init__(self, identifiers, columns, people, lists, subjects):
+        self.identifiers = identifiers
+        self.rows = {identifier: row for row, identifier in
+                     enumerate(identifiers)}
+        self.people = people
+        self.lists = lists
+        self.subjects = subjects
+
+        self.author_date = columns['author_date']
+        self.author_offset = columns['author_offset']
+        self.author = columns['author']
+        self.committer_date = columns['committer_date']
+        self.committer_offset = columns['committer_offset']
+        self.committer = columns['committer']
+        self.lines = columns['lines']
+        self.is_revert = columns['is_revert']
+        self.list_ptr = columns['list_ptr']
+        self.list_idx = columns['list_idx']
+
+    @staticmethod
+    def build(headers, get_lists=None):
+        """
+        Build the index from headers
+        :param headers: Iterable of Header objects
+        :param get_lists: Optional callable that returns the lists of a
+               message id
+        """
+        headers = sorted(headers, key=lambda header: header.identifier)
+        num = len(headers)
+
+        author_date = np.zeros(num, dtype=np.int64)
+        author_offset = np.zeros(num, dtype=np.int16)
+        author = np.zeros(num, dtype=np.int32)
+        committer_date = np.zeros(num, dtype=np.int64)
+        committer_offset = np.zeros(num, dtype=np.int16)
+        committer = np.full(num, MetaIndex.NONE, dtype=np.int32)
+        lines = np.zeros(num, dtype=np.int32)
+        is_revert = np.zeros(num, dtype=np.bool_)
+        list_ptr = np.zeros(num + 1, dtype=np.int64)
+        list_idx = list()
+
+        people = dict()
+        lists = dict()
+
+        def person(signature):
+            return people.setdefault((signature.name, signature.email),
+                                     len(people))
+
+        def epoch(date):
+            return int(date.timestamp()), \
+                   int(date.utcoffset().total_seconds()) // 60
+
+        for row, header in enumerate(headers):
+            author_date[row], author_offset[row] = epoch(header.author.date)
+            author[row] = person(header.author)
+            if header.committer:
+                committer_date[row], committer_offset[row] = \
+                    epoch(header.committer.date)
+                committer[row] = person(header.committer)
+            lines[row] = header.lines
+            is_revert[row] = header.is_revert
+
+            if get_lists and header.identifier[0] == '<':
+                for listaddr in sorted(get_lists(header.identifier)):
+                    list_idx.append(lists.setdefault(listaddr, len(lists)))
+            list_ptr[row + 1] = len(list_idx)
+
+        columns = {
+            'author_date': author_date,
+            'author_offset': author_offset,
+            'author': author,
+            'committer_date': committer_date,
+            'committer_offset': committer_offset,
+            'committer': committer,
+            'lines': lines,
+            'is_revert': is_revert,
+            'list_ptr': list_ptr,
+            'list_idx': np.array(list_idx, dtype=np.int32),
+        }
+
+        return MetaIndex([header.identifier for header in headers], columns,
+                         list(people.keys()), list(lists.keys()),
+                         [header.subject for header in headers])
+
+    @staticmethod
+    def load(f_index):
+        log.info('Loading metadata index')
+        try:
+            with open(f_index, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            log.info('  ↪ Warning, metadata index %s not found!' % f_index)
+            return None
+
+        if data['version'] != MetaIndex.VERSION:
+            log.info('  ↪ Warning, metadata index %s is outdated!' % f_index)
+            return None
+
+        index = MetaIndex([intern(x) for x in data['identifiers']],
+                          data['columns'],
+                          [(intern(name), intern(email)) for name, email in
+                           data['people']],
+                          [intern(x) for x in data['lists']],
+                          data['subjects'])
+        log.info('  ↪ Loaded metadata of %d commits and mails' % len(index))
+        return index
+
+    def export(self, f_index):
+        log.info('Writing metadata index of %d commits and mails' % len(self))
+        columns = {
+            'author_date': self.author_date,
+            'author_offset': self.author_offset,
+            'author': self.author,
+            'committer_date': self.committer_date,
+            'committer_offset': self.committer_offset,
+            'committer': self.committer,
+            'lines': self.lines,
+            'is_revert': self.is_revert,
+            'list_ptr': self.list_ptr,
+            'list_idx': self.list_idx,
+        }
+        os.makedirs(dirname(f_index), exist_ok=True)
+        with open(f_index, 'wb') as f:
+            pickle.dump({'version': MetaIndex.VERSION,
+                         'identifiers': self.identifiers,
+                         'columns': columns,
+                         'people': self.people,
+                         'lists': self.lists,
+                         'subjects': self.subjects},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __contains__(self, identifier):
+        return identifier in self.rows
+
+    def get_rows(self, identifiers):
+        """
+        Rows of a collection of identifiers. Raises KeyError if an identifier
+        is unknown.
+        """
+        return np.fromiter((self.rows[x] for x in identifiers),
+                           dtype=np.int64, count=len(identifiers))
+
+    @staticmethod
+    def _to_datetime(epoch, offset):
+        tz = datetime.timezone(datetime.timedelta(minutes=int(offset)))
+        return datetime.datetime.fromtimestamp(int(epoch), tz)
+
+    def get_author_date(self, identifier):
+        row = self.rows[identifier]
+        return self._to_datetime(self.author_date[row],
+                                 self.author_offset[row])
+
+    def get_committer_date(self, identifier):
+        row = self.rows[identifier]
+        if self.committer[row] == MetaIndex.NONE:
+            return None
+        return self._to_datetime(self.committer_date[row],
+                                 self.committer_offset[row])
+
+    def get_author(self, identifier):
+        """
+        :return: tuple of name and email
+        """
+        return self.people[self.author[self.rows[identifier]]]
+
+    def get_committer(self, identifier):
+        """
+        :return: tuple of name and email, or None for mails
+        """
+        committer = self.committer[self.rows[identifier]]
+        if committer == MetaIndex.NONE:
+            return None
+        return self.people[committer]
+
+    def get_subject(self, identifier):
+        return self.subjects[self.rows[identifier]]
+
+    def get_lines(self, identifier):
+        return int(self.lines[self.rows[identifier]])
+
+    def get_lists(self, identifier):
+        row = self.rows[identifier]
+        idx = self.list_idx[self.list_ptr[row]:self.list_ptr[row + 1]]
+        return {self.lists[x] for x in idx}
+
+    def extremes(self, identifiers, committer=False):
+        """
+        Find the identifiers with the earliest and the latest date
+        :param identifiers: Sequence of identifiers
+        :param committer: Respect the committer date instead of the author date
+        :return: tuple of the earliest and the latest identifier
+        """
+        identifiers = list(identifiers)
+        rows = self.get_rows(identifiers)
+        dates = self.committer_date if committer else self.author_date
+        dates = dates[rows]
+        return identifiers[int(np.argmin(dates))], \
+               identifiers[int(np.argmax(dates))]
+
+    def in_window(self, since, until, committer=False):
+        """
+        Identifiers whose date lies within [since, until]
+        """
+        dates = self.committer_date if committer else self.author_date
+        mask = (dates >= int(since.timestamp())) & \
+               (dates <= int(until.timestamp()))
+        if committer:
+            mask &= self.committer != MetaIndex.NONE
+        return {self.identifiers[x] for x in np.flatnonzero(mask)}
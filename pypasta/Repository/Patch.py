@@ -10,14 +10,128 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 
+import hashlib
+import pickle
 import re
-import subprocess
+
+from sys import intern
+from weakref import WeakValueDictionary
+
+from .RawPack import RawPack
+
+# Content-addressed table of parsed diffs: identical diffs (cross-posts,
+# resends, cherry-picks of mails) share a single Diff object. The table
+# doesn't keep diffs alive, they vanish together with their last commit.
+_diffs = WeakValueDictionary()
+# Persistent store of parsed diffs, keyed by their digest, see set_diff_store()
+_diff_store = None
+
+
+def diff_digest(diff):
+    digest = hashlib.blake2b(digest_size=16)
+    for line in diff:
+        digest.update(line.encode('utf-8', 'surrogatepass'))
+        digest.update(b'\n')
+    return digest.digest()
+
+
+def parse_diff(diff, keep_raw=False):
+    """
+    Parse a diff, or return the Diff object of an identical diff that was
+    parsed before. Diffs with raw lines are never shared.
+    """
+    if keep_raw:
+        return Diff(diff, keep_raw=True)
+
+    digest = diff_digest(diff)
+    parsed = _diffs.get(digest)
+    if parsed is None:
+        parsed = _load_diff(digest)
+    if parsed is None:
+        parsed = Diff(diff)
+        parsed.digest = digest
+        _diffs[digest] = parsed
+
+    return parsed
+
+
+def set_diff_store(store):
+    """
+    :param store: RawPack of pickled diff states, or None
+    """
+    global _diff_store
+    _diff_store = store
+
+
+def diff_is_stored(digest):
+    return _diff_store is not None and digest.hex() in _diff_store
+
+
+def encode_diff(diff):
+    """
+    :return: tuple of key, flags and data, as the diff store expects it
+    """
+    return (diff.digest.hex(),
+            *RawPack.encode(pickle.dumps(diff.__getstate__(),
+                                         pickle.HIGHEST_PROTOCOL)))
+
+
+def _load_diff(digest):
+    if _diff_store is None:
+        return None
+
+    data = _diff_store.get(digest.hex())
+    if data is None:
+        return None
+
+    return _unpickle_diff(pickle.loads(data))
+
+
+def resolve_diff(digest):
+    diff = _diffs.get(digest)
+    if diff is None:
+        diff = _load_diff(digest)
+    if diff is None:
+        raise KeyError('Diff %s is not in the diff store' % digest.hex())
+    return diff
+
+
+def clear_diffs():
+    _diffs.clear()
+
+
+def _unpickle_diff(state):
+    # Route unpickling through the content-addressed table
+    diff = Diff.__new__(Diff)
+    diff.__setstate__(state)
+    if diff.digest is None:
+        return diff
+    return _diffs.setdefault(diff.digest, diff)
+
+
+class DiffPickler(pickle.Pickler):
+    """
+    Pickles shared diffs by their digest only, for caches whose diffs live in
+    the diff store
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, Diff) and obj.digest is not None:
+            return obj.digest
+        return None
+
+
+class DiffUnpickler(pickle.Unpickler):
+    def persistent_load(self, digest):
+        return resolve_diff(digest)
+
 
 class Hunk:
-    def __init__(self, insertions=None, deletions=None, context=None):
-        self.insertions = insertions or []
-        self.deletions = deletions or []
-        self.context = context or []
+    __slots__ = ('insertions', 'deletions', 'context')
+
+    def __init__(self, insertions=(), deletions=(), context=()):
+        self.insertions = tuple(insertions)
+        self.deletions = tuple(deletions)
+        self.context = tuple(context)
 
     def merge(self, other):
         self.insertions += other.insertions
@@ -25,6 +139,8 @@ class Hunk:
         self.context += other.context
 
 class Patch:
+    __slots__ = ('similarity', 'hunks')
+
     def __init__(self, similarity=0, hunks=None):
         self.similarity = similarity
         if hunks:
@@ -34,6 +150,9 @@ class Patch:
 
 
 class Diff:
+    STATE = ('patches', 'affected', 'lines', 'footer', 'raw', 'digest')
+    __slots__ = STATE + ('__weakref__',)
+
     # The two-line unified diff headers
     FILE_SEPARATOR_MINUS_REGEX = re.compile(r'^--- ([^\s]+).*$')
     #r'^--- (?P<filename>[^\t\n]+)(?:\t(?P<timestamp>[^\n]+))?')
@@ -41,6 +160,11 @@ class Diff:
 
     CONTEXT_DIFF_REGEX = re.compile(r'\*\*\*\s*\d+,\s*\d+\s*\*\*\*')
 
+    # Building blocks of context diffs
+    CONTEXT_HUNK_SEPARATOR_REGEX = re.compile(r'^\*{15}[ ]?(.*)$')
+    CONTEXT_OLD_RANGE_REGEX = re.compile(r'^\*\*\* (\d+)(?:,(\d+))? \*\*\*\*')
+    CONTEXT_NEW_RANGE_REGEX = re.compile(r'^--- (\d+)(?:,(\d+))? ----')
+
     # Exclude '--cc' diffs
     EXCLUDE_CC_REGEX = re.compile(r'^diff --cc (.+)$')
 
@@ -57,29 +181,37 @@ class Diff:
 
     REGEX_ORIG = re.compile(r'\.orig$')
 
-    def __init__(self, diff):
+    def __init__(self, diff, keep_raw=False, keep_context=False):
+        """
+        :param diff: List of lines of the diff
+        :param keep_raw: Keep the raw lines of the diff. They're only required
+               for displaying diffs, and can be rebuilt at any time, so don't
+               waste memory (and cache size) by default.
+        :param keep_context: Keep context lines of hunks
+        """
         def insert_file(filenames, similarity):
-            self.affected |= set(filenames)
+            affected.update(filenames)
             if filenames not in self.patches:
                 self.patches[filenames] = Patch(similarity=similarity)
 
         # Check if we have a context diff. We should see something
         # like "**** 123, 456 ***" within the first few lines.
         for line in diff[0:10]:
-            if Diff.CONTEXT_DIFF_REGEX.match(line):
-                ctx_diff = '\n'.join(diff).encode()
-                p = subprocess.run(['filterdiff', '--format=unified'],
-                                   input=ctx_diff, stdout=subprocess.PIPE)
-                if p.returncode != 0:
-                    raise ValueError("Unable to convert context diff to unified diff")
-                diff = p.stdout.decode().split('\n')
+            if Diff.CONTEXT_DIFF_REGEX.match(line) or \
+               Diff.CONTEXT_OLD_RANGE_REGEX.match(line):
+                diff = Diff.context_to_unified(diff)
                 break
 
         # we pop from the list until it is empty. Copy it first, to prevent its
         # deletion
-        diff = diff.copy()
+        diff = list(diff)
+
+        # Only set for shared diffs, see parse_diff()
+        self.digest = None
 
-        self.raw = diff.copy()
+        self.raw = None
+        if keep_raw:
+            self.raw = tuple(diff)
 
         # patches store patches of files
         #  key: (filename,) or (old_filename, new_filename)
@@ -87,9 +219,10 @@ class Diff:
         self.patches = {}
 
         # Set of all filenames that were affected by this diff
-        self.affected = set()
+        affected = set()
 
         self.lines = 0
+        self.footer = 0
 
         # Check if we understand the diff format
         if diff and Diff.EXCLUDE_CC_REGEX.match(diff[0]):
@@ -127,7 +260,7 @@ class Diff:
 
                         # In case we parse the 'rename from/to' lines, we must
                         # not sanitise the filenames and strip away anything
-                        filenames = minus, plus
+                        filenames = intern(minus), intern(plus)
 
                         break
 
@@ -151,7 +284,7 @@ class Diff:
                 if hunk.group(4):
                     r_lines = int(hunk.group(4))
 
-                hunk_heading = hunk.group(5)
+                hunk_heading = intern(hunk.group(5))
 
                 del_cntr = 0
                 add_cntr = 0
@@ -187,7 +320,8 @@ class Diff:
                         del_cntr += 1
                         self.lines += 1
                     elif identifier == Diff.LINE_IDENTIFIER_CONTEXT:
-                        context.append(payload)
+                        if keep_context:
+                            context.append(payload)
                         add_cntr += 1
                         del_cntr += 1
                     elif identifier == Diff.LINE_IDENTIFIER_NEWLINE:  # '\ No new line' statements
@@ -197,9 +331,9 @@ class Diff:
                         continue
 
                 # remove empty lines
-                insertions = list(filter(None, insertions))
-                deletions = list(filter(None, deletions))
-                context = list(filter(None, context))
+                insertions = filter(None, insertions)
+                deletions = filter(None, deletions)
+                context = filter(None, context)
 
                 h = Hunk(insertions, deletions, context)
 
@@ -212,16 +346,202 @@ class Diff:
                 self.patches[filenames].hunks[hunk_heading].merge(h)
                 self.footer = len(diff)
 
-        self.affected.discard('/dev/null')
+        affected.discard('/dev/null')
+        self.affected = frozenset(affected)
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in Diff.STATE)
+
+    def __reduce__(self):
+        return _unpickle_diff, (self.__getstate__(),)
+
+    def __setstate__(self, state):
+        # Caches of older versions lack the digest
+        self.digest = None
+        for attr, value in zip(Diff.STATE, state):
+            setattr(self, attr, value)
+
+        # Unpickled strings are distinct objects. Intern filenames and hunk
+        # headings, they massively repeat across commits.
+        self.patches = {tuple(map(intern, filenames)): patch
+                        for filenames, patch in self.patches.items()}
+        for patch in self.patches.values():
+            patch.hunks = {intern(heading): hunk
+                           for heading, hunk in patch.hunks.items()}
+        self.affected = frozenset(map(intern, self.affected))
+
+    @staticmethod
+    def context_to_unified(diff):
+        """
+        context_to_unified: Convert a context diff (diff -c) to a unified diff
+
+        Lines that neither belong to file headers nor to hunks are passed
+        through unaltered, so the result can be parsed like any other diff.
+        """
+        def split_line(line):
+            # Mailers love to strip trailing whitespaces. An empty line
+            # therefore is an (empty) context line.
+            if len(line) == 0:
+                return ' ', ''
+            if line[0] == Diff.LINE_IDENTIFIER_NEWLINE:
+                return line[0], line
+            if len(line) > 1 and line[1] == ' ':
+                return line[0], line[2:]
+            return line[0], line[1:]
+
+        def is_body(line, required):
+            if line[0:2] in ('  ', '- ', '+ ', '! '):
+                return True
+            return required and line in ('', ' ', '-', '+', '!')
+
+        def starts_section(diff, i):
+            while i < len(diff) and is_body(diff[i], True) and \
+                  not is_body(diff[i], False):
+                i += 1
+            return i < len(diff) and is_body(diff[i], False)
+
+        def format_range(start, count):
+            if count == 1:
+                return '%u' % start
+            return '%u,%u' % (start, count)
+
+        def merge(old, new):
+            ret = []
+            o_count = n_count = 0
+            i = j = 0
+            while i < len(old) or j < len(new):
+                progress = False
+                while i < len(old) and old[i][0] in '-!\\':
+                    identifier, payload = old[i]
+                    if identifier == Diff.LINE_IDENTIFIER_NEWLINE:
+                        ret.append(payload)
+                    else:
+                        ret.append('-' + payload)
+                        o_count += 1
+                    i += 1
+                    progress = True
+
+                while j < len(new) and new[j][0] in '+!\\':
+                    identifier, payload = new[j]
+                    if identifier == Diff.LINE_IDENTIFIER_NEWLINE:
+                        ret.append(payload)
+                    else:
+                        ret.append('+' + payload)
+                        n_count += 1
+                    j += 1
+                    progress = True
+
+                if i < len(old) and j < len(new):
+                    ret.append(' ' + old[i][1])
+                    o_count += 1
+                    n_count += 1
+                    i += 1
+                    j += 1
+                    progress = True
+                    # '\ No newline at end of file' after a common line
+                    if i < len(old) and j < len(new) and \
+                       old[i][0] == new[j][0] == Diff.LINE_IDENTIFIER_NEWLINE:
+                        ret.append(old[i][1])
+                        i += 1
+                        j += 1
+
+                if not progress:
+                    raise ValueError('Unable to convert context diff to '
+                                     'unified diff')
+
+            return ret, o_count, n_count
+
+        ret = []
+        i = 0
+        while i < len(diff):
+            line = diff[i]
+            i += 1
+
+            # File headers: '*** old' and '--- new'
+            if line.startswith('*** ') and i < len(diff) and \
+               diff[i].startswith('--- ') and \
+               not Diff.CONTEXT_OLD_RANGE_REGEX.match(line) and \
+               not Diff.CONTEXT_NEW_RANGE_REGEX.match(diff[i]):
+                ret.append('--- ' + line[4:])
+                ret.append('+++ ' + diff[i][4:])
+                i += 1
+                continue
+
+            separator = Diff.CONTEXT_HUNK_SEPARATOR_REGEX.match(line)
+            if not separator or i == len(diff) or \
+               not Diff.CONTEXT_OLD_RANGE_REGEX.match(diff[i]):
+                ret.append(line)
+                continue
+
+            heading = separator.group(1)
+            o_start = int(Diff.CONTEXT_OLD_RANGE_REGEX.match(diff[i]).group(1))
+            i += 1
+
+            old = []
+            while i < len(diff) and \
+                  not Diff.CONTEXT_NEW_RANGE_REGEX.match(diff[i]):
+                old.append(split_line(diff[i]))
+                i += 1
+            if i == len(diff):
+                raise ValueError('Unable to convert context diff to unified '
+                                 'diff')
+
+            match = Diff.CONTEXT_NEW_RANGE_REGEX.match(diff[i])
+            n_start = int(match.group(1))
+            if match.group(2):
+                expected = int(match.group(2)) - n_start + 1
+            else:
+                expected = 1 if n_start else 0
+            i += 1
+
+            # The new section must be present if the old section is missing,
+            # or if it contains changes. Otherwise, it's omitted if it only
+            # consists of context.
+            required = not old or any(x[0] == '!' for x in old)
+            new = []
+            lines = 0
+            while i < len(diff):
+                line = diff[i]
+                if line.startswith(Diff.LINE_IDENTIFIER_NEWLINE):
+                    new.append(split_line(line))
+                    i += 1
+                    continue
+                # Once the section started, mangled lines are body as well.
+                # Leading mangled lines need a proper successor.
+                started = required or lines > 0 or starts_section(diff, i)
+                if lines == expected or not is_body(line, started):
+                    break
+                new.append(split_line(line))
+                lines += 1
+                i += 1
+
+            # Omitted sections only consist of context
+            if not old:
+                old = [x for x in new if x[0] == ' ']
+            if not new:
+                new = [x for x in old if x[0] == ' ']
+
+            body, o_count, n_count = merge(old, new)
+            header = '@@ -%s +%s @@' % (format_range(o_start, o_count),
+                                        format_range(n_start, n_count))
+            if heading:
+                header += ' ' + heading
+            ret.append(header)
+            ret += body
+
+        return ret
 
     def split_footer(self):
+        if self.raw is None:
+            raise ValueError('Raw diff not available')
+
         if self.footer > 0:
-            diff = self.raw[:-self.footer]
-            footer = self.raw[-self.footer:]
+            diff = list(self.raw[:-self.footer])
+            footer = list(self.raw[-self.footer:])
 
             return diff, footer
 
-        return self.raw.copy(), []
+        return list(self.raw), []
 
     @staticmethod
     def get_filename(a, b):
@@ -242,6 +562,9 @@ class Diff:
         a = sanitise_filename(a)
         b = sanitise_filename(b)
 
+        a = intern(a)
+        b = intern(b)
+
         # no move - we modify the file in place
         if a == b:
             return a,
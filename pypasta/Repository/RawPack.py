@@ -0,0 +1,187 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import fcntl
+import numpy as np
+import os
+
+from logging import getLogger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = getLogger(__name__[-15:])
+
+_compressor = None
+
+
+class RawPack:
+    """
+    Append-only archive of raw mails, keyed by the md5 of the mail. Mails
+    are stored back to back in the pack file, optionally compressed with
+    zstd. The pack index holds one fixed-size record per mail. Any other
+    data with a 128-bit key can be stored likewise.
+    """
+    FLAG_ZSTD = 1
+    RECORD = np.dtype([('md5', 'S16'), ('offset', '<u8'), ('length', '<u4'),
+                       ('flags', '<u4')])
+
+    def __init__(self, f_pack):
+        self.f_pack = f_pack
+        self.f_pack_index = f_pack + '.idx'
+        self.fd = None
+        self.load()
+
+    def load(self):
+        data = b''
+        try:
+            with open(self.f_pack_index, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            pass
+
+        # Drop a partially written record
+        num = len(data) // self.RECORD.itemsize
+        records = np.frombuffer(data, dtype=self.RECORD, count=num)
+        self.records = records[np.argsort(records['md5'], kind='stable')]
+
+        self.reopen()
+
+    def reopen(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if os.path.isfile(self.f_pack):
+            self.fd = os.open(self.f_pack, os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _find(self, md5):
+        key = np.array(bytes.fromhex(md5), dtype='S16')
+        pos = int(np.searchsorted(self.records['md5'], key))
+        if pos < len(self.records) and self.records['md5'][pos] == key:
+            return self.records[pos]
+        return None
+
+    def __contains__(self, md5):
+        return self._find(md5) is not None
+
+    def order(self, md5s):
+        """
+        :return: positions of md5s, sorted by their offset in the pack.
+                 Unpacked mails come last.
+        """
+        offsets = np.full(len(md5s), np.iinfo(np.uint64).max, dtype=np.uint64)
+        for pos, md5 in enumerate(md5s):
+            record = self._find(md5)
+            if record is not None:
+                offsets[pos] = record['offset']
+
+        return np.argsort(offsets, kind='stable')
+
+    def get(self, md5):
+        """
+        :return: the raw mail, or None if it is not packed
+        """
+        record = self._find(md5)
+        if record is None:
+            return None
+
+        data = os.pread(self.fd, int(record['length']), int(record['offset']))
+        if record['flags'] & self.FLAG_ZSTD:
+            if not zstandard:
+                raise RuntimeError('zstandard is required to read %s' %
+                                   self.f_pack)
+            data = zstandard.ZstdDecompressor().decompress(data)
+
+        return data
+
+    @staticmethod
+    def encode(raw):
+        """
+        Prepare a mail for packing. Expensive, hence done by workers.
+        :return: tuple of flags and data
+        """
+        global _compressor
+
+        if not zstandard:
+            return 0, raw
+
+        if _compressor is None:
+            _compressor = zstandard.ZstdCompressor(level=3)
+        return RawPack.FLAG_ZSTD, _compressor.compress(raw)
+
+    def append(self, items):
+        """
+        Append encoded mails to the pack
+        :param items: iterable of tuples (md5, flags, data)
+        :return: number of appended mails
+        """
+        records = list()
+        seen = set()
+
+        with open(self.f_pack, 'ab') as f_pack, \
+             open(self.f_pack_index, 'ab') as f_index:
+            # Several updaters may run in parallel
+            fcntl.flock(f_pack, fcntl.LOCK_EX)
+            f_pack.seek(0, os.SEEK_END)
+            offset = f_pack.tell()
+
+            for md5, flags, data in items:
+                if md5 in seen or md5 in self:
+                    continue
+                seen.add(md5)
+
+                f_pack.write(data)
+                records.append((bytes.fromhex(md5), offset, len(data), flags))
+                offset += len(data)
+
+            # Data must hit the disk before the index refers to it
+            f_pack.flush()
+            os.fsync(f_pack.fileno())
+            f_index.write(np.array(records, dtype=self.RECORD).tobytes())
+            f_index.flush()
+            os.fsync(f_index.fileno())
+
+        self.load()
+        return len(records)
+
+    def prune(self, keep):
+        """
+        Drops everything but keep from the pack
+        :param keep: keys that remain
+        :return: number of remaining entries
+        """
+        keep = np.array([bytes.fromhex(key) for key in keep], dtype='S16')
+        records = self.records[np.isin(self.records['md5'], keep)]
+        if len(records) == len(self.records):
+            return len(records)
+
+        records = records[np.argsort(records['offset'], kind='stable')]
+        f_pack_tmp = self.f_pack + '.tmp'
+        f_pack_index_tmp = self.f_pack_index + '.tmp'
+        with open(f_pack_tmp, 'wb') as f:
+            for offset, length in zip(records['offset'], records['length']):
+                f.write(os.pread(self.fd, int(length), int(offset)))
+        lengths = records['length'].astype(np.uint64)
+        records['offset'] = np.cumsum(lengths) - lengths
+        with open(f_pack_index_tmp, 'wb') as f:
+            f.write(records.tobytes())
+
+        os.replace(f_pack_tmp, self.f_pack)
+        os.replace(f_pack_index_tmp, self.f_pack_index)
+
+        self.load()
+        return len(records)
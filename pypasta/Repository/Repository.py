@@ -11,26 +11,42 @@ the COPYING file in the top-level directory.
 """
 
 import gc
-import git
+import glob
+import os
 import pickle
 import pygit2
 import re
+import shutil
 
 from bisect import bisect_right
+from itertools import chain
 from logging import getLogger
+from os.path import dirname, isfile, join
+from sys import intern
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 from tqdm import tqdm
 
-from .MessageDiff import MessageDiff, Signature
+from .MessageDiff import MessageDiff, Signature, clear_signatures, \
+    intern_signature
 from .Mbox import Mbox
-from ..Util import fix_encoding, get_commit_hash_range,\
-                   pygit2_signature_to_datetime
+from .Patch import DiffPickler, DiffUnpickler, clear_diffs, \
+    diff_is_stored, encode_diff, set_diff_store
+from .MetaIndex import MetaIndex
+from .RawPack import RawPack
+from ..Util import fix_encoding, get_commit_hash_range, iter_chunks, \
+                   pygit2_signature_to_datetime, resolve_commit_range, \
+                   walk_commits
 
 log = getLogger(__name__[-15:])
 
 # We need this global variable, as pygit2 Repository objects are not pickleable
 _tmp_repo = None
+# Commit, header and diff cache files that workers write to
+_tmp_store = None
+
+# Number of commits per pickled chunk of on-disk caches
+CACHE_CHUNK_SIZE = 1000
 
 mainline_regex = {
     'buildroot': re.compile(r'^(\d{4}\.\d{2})(_rc\d+)?$'),
@@ -48,11 +64,11 @@ mainline_regex = {
 class Commit(MessageDiff):
     @staticmethod
     def get_signature(pygit_person):
-        return Signature(fix_encoding(pygit_person.raw_name),
-                         pygit_person.email,
-                         pygit2_signature_to_datetime(pygit_person))
+        return intern_signature(
+            Signature(fix_encoding(pygit_person.raw_name), pygit_person.email,
+                      pygit2_signature_to_datetime(pygit_person)))
 
-    def __init__(self, repo, commit_hash):
+    def __init__(self, repo, commit_hash, keep_raw=False):
         commit = repo[commit_hash]
 
         author = Commit.get_signature(commit.author)
@@ -75,7 +91,8 @@ class Commit(MessageDiff):
 
         content = message, None, diff
 
-        super(Commit, self).__init__(str(commit.id), content, author)
+        super(Commit, self).__init__(str(commit.id), content, author,
+                                     keep_raw)
 
     def format_message(self):
         custom = ['Committer:  %s <%s>' %
@@ -84,19 +101,157 @@ class Commit(MessageDiff):
         return super(Commit, self).format_message(custom)
 
 
-def _load_commit_subst(commit_hash):
-    return commit_hash, _tmp_repo._load_commit(commit_hash)
+def write_chunks(f, items):
+    chunk = dict()
+    for key, value in items:
+        chunk[key] = value
+        if len(chunk) == CACHE_CHUNK_SIZE:
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+            chunk = dict()
+    if chunk:
+        pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _spill_location(filename, pid):
+    return '%s.%d' % (filename, pid)
+
+
+def _remove_spills(filename):
+    # Spill files of a crashed run must not end up in the store, even if a
+    # worker gets the same pid
+    for spill in glob.glob(glob.escape(filename) + '.*'):
+        if spill[len(filename) + 1:].isdigit():
+            os.remove(spill)
+
+
+def _init_worker():
+    # libgit2 handles must not be shared across processes
+    _tmp_repo.reopen()
+
+
+def _load_commits_subst(identifiers):
+    return list(_tmp_repo._load_commits(identifiers))
+
+
+def _patch_ids_subst(commit_hashes):
+    repo = _tmp_repo.repo
+    result = list()
+    for commit_hash in commit_hashes:
+        commit = repo[commit_hash]
+        if commit.parents:
+            diff = repo.diff(commit.parents[0], commit)
+        else:
+            diff = commit.tree.diff_to_tree(swap=True)
+        # Empty commits don't have a patch id
+        patch_id = str(diff.patchid) if len(diff) else None
+        result.append((commit_hash, patch_id))
+    return result
+
+
+def _store_commits_subst(identifiers):
+    """
+    Loads a chunk of commits and appends them, their headers and their diffs
+    that aren't yet in the diff store to the spill files of this process.
+    Only identifiers go back to the parent.
+    """
+    f_ccache, f_hcache, f_dcache = _tmp_store
+    pid = os.getpid()
+
+    commits = dict()
+    invalid = list()
+    for identifier, commit in _tmp_repo._load_commits(identifiers):
+        if commit is None:
+            invalid.append(identifier)
+        else:
+            commits[identifier] = commit
+
+    if commits:
+        with open(_spill_location(f_ccache, pid), 'ab') as f:
+            DiffPickler(f, pickle.HIGHEST_PROTOCOL).dump(commits)
+        with open(_spill_location(f_hcache, pid), 'ab') as f:
+            pickle.dump({key: value.header for key, value in commits.items()},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    # Commit caches only refer to diffs by their digest
+    diffs = {commit.diff.digest: commit.diff for commit in commits.values()
+             if commit.diff.digest is not None}
+    diffs = [encode_diff(diff) for digest, diff in diffs.items()
+             if not diff_is_stored(digest)]
+    if diffs:
+        with open(_spill_location(f_dcache, pid), 'ab') as f:
+            pickle.dump(diffs, f, pickle.HIGHEST_PROTOCOL)
+
+    return pid, list(commits.keys()), invalid
 
 
 class Repository:
     REGEX_TAGS = re.compile('^refs/tags')
 
-    def __init__(self, project_name, repo_location):
+    def __init__(self, project_name, repo_location, f_tags=None):
+        """
+        :param project_name: Name of the project
+        :param repo_location: Location of the git repository
+        :param f_tags: Optional cache file for tags. Walking all tags is
+               expensive on large repositories.
+        """
         self.repo_location = repo_location
         self.ccache = {}
+        # Header cache: the cheap tier of commits and mails
+        self.hcache = {}
+        # Store of previously parsed diffs, see load_dcache()
+        self.dcache = None
+        # Columnar metadata index, if loaded
+        self.meta = None
         self.repo = pygit2.Repository(repo_location)
         self.mbox = None
+        # First mainline tag that contains a commit, see load_releases()
+        self.releases = None
+
+        fingerprint = self._tags_fingerprint()
+        if f_tags and isfile(f_tags):
+            with open(f_tags, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['fingerprint'] == fingerprint and \
+               cache['project'] == project_name:
+                self.tags, self.mainline_tags = cache['tags']
+                self._mainline_tag_dates = [dt for _, dt in self.mainline_tags]
+                self._mainline_tag_date = dict(self.mainline_tags)
+                return
+
+        self._load_tags(project_name)
+
+        if f_tags:
+            log.debug('Writing tag cache %s' % f_tags)
+            os.makedirs(dirname(f_tags), exist_ok=True)
+            with open(f_tags, 'wb') as f:
+                pickle.dump({'fingerprint': fingerprint,
+                             'project': project_name,
+                             'tags': (self.tags, self.mainline_tags)},
+                            f, pickle.HIGHEST_PROTOCOL)
+
+    def _tags_fingerprint(self):
+        """
+        Cheap fingerprint of all tags of the repository. Adding, moving or
+        removing loose tags modifies their directory below refs/tags, packing
+        refs replaces packed-refs.
+        """
+        fingerprint = list()
+
+        f_packed_refs = join(self.repo.path, 'packed-refs')
+        if isfile(f_packed_refs):
+            stat = os.stat(f_packed_refs)
+            fingerprint.append(('packed-refs', stat.st_ino, stat.st_size,
+                                stat.st_mtime_ns))
+
+        d_tags = join(self.repo.path, 'refs', 'tags')
+        for d_tag, _, _ in os.walk(d_tags):
+            stat = os.stat(d_tag)
+            fingerprint.append((os.path.relpath(d_tag, d_tags), stat.st_ino,
+                                stat.st_mtime_ns))
+
+        return fingerprint
 
+    def _load_tags(self, project_name):
         self.tags = list()
         tag_refs = filter(lambda r: self.REGEX_TAGS.match(r),
                           self.repo.listall_references())
@@ -130,11 +285,74 @@ class Repository:
             log.warning('No Version support for %s' % project_name)
             self.mainline_tags = []
             self._mainline_tag_dates = []
+            self._mainline_tag_date = dict()
             return
 
         self.mainline_tags = list(filter(
             lambda x : mainline_regex[project_name].match(x[0]), self.tags))
         self._mainline_tag_dates = [dt for _, dt in self.mainline_tags]
+        self._mainline_tag_date = dict(self.mainline_tags)
+
+    def _mainline_tag_targets(self):
+        return [(tag, str(self.repo.revparse_single('refs/tags/%s' % tag).
+                          peel(pygit2.Commit).id))
+                for tag, _ in self.mainline_tags]
+
+    def load_releases(self, f_releases):
+        """
+        Loads the index that maps commits to the first mainline tag that
+        contains them. Mainline tags are walked in chronological order, each
+        walk hides all earlier tags. Hence, every commit is visited exactly
+        once. The index file is a stream of per-tag records, new tags are
+        appended.
+        """
+        log.info('Loading release index')
+        targets = self._mainline_tag_targets()
+        releases = dict()
+        done = list()
+
+        if isfile(f_releases):
+            for tag, target, commits in iter_chunks(f_releases):
+                done.append((tag, target))
+                releases.update((commit, tag) for commit in commits)
+
+            if done != targets[:len(done)]:
+                log.info('  ↪ Tags changed, rebuilding release index')
+                releases = dict()
+                done = list()
+                os.remove(f_releases)
+
+        if len(done) < len(targets):
+            os.makedirs(dirname(f_releases), exist_ok=True)
+
+        for tag, target in tqdm(targets[len(done):], desc='Walking tags',
+                                unit='tag'):
+            walker = self.repo.walk(pygit2.Oid(hex=target),
+                                    pygit2.GIT_SORT_NONE)
+            for _, hidden in done:
+                walker.hide(pygit2.Oid(hex=hidden))
+
+            tag = intern(tag)
+            commits = [str(commit.id) for commit in walker]
+            releases.update((commit, tag) for commit in commits)
+            done.append((tag, target))
+
+            with open(f_releases, 'ab') as f:
+                pickle.dump((tag, target, commits), f,
+                            pickle.HIGHEST_PROTOCOL)
+
+        self.releases = releases
+        log.info('  ↪ %d commits in %d releases' % (len(releases), len(done)))
+
+    def get_release(self, commit_hash):
+        """
+        :return: the first mainline tag that contains the commit, and its date.
+                 None, if the commit is not yet released.
+        """
+        tag = self.releases.get(commit_hash)
+        if tag is None:
+            return None
+        return tag, self._mainline_tag_date[tag]
 
     def patch_get_version(self, patch):
         date = patch.author.date
@@ -151,18 +369,51 @@ class Repository:
 
     def clear_commit_cache(self):
         self.ccache.clear()
+        self.hcache.clear()
+        clear_signatures()
+        clear_diffs()
 
-    def _load_commit(self, identifier):
+    def _load_commit(self, identifier, keep_raw=False, raws=None):
         # check if the victim is an email
         try:
             if identifier[0] == '<':
-                return self.mbox[identifier]
+                return self.mbox.get_patch(identifier, keep_raw, raws)
             else:
-                return Commit(self.repo, identifier)
+                return Commit(self.repo, identifier, keep_raw)
         except Exception as e:
             log.debug('Unable to load commit %s: %s' % (identifier, str(e)))
             return None
 
+    def _load_commits(self, identifiers):
+        """
+        Loads several commits. Mails are read ahead by the mailbox.
+        :return: iterator of tuples (identifier, commit), commit is None if it
+                 can't be loaded
+        """
+        mails = list()
+        for identifier in identifiers:
+            if identifier[0] == '<' and self.mbox:
+                mails.append(identifier)
+            else:
+                yield identifier, self._load_commit(identifier)
+
+        if not mails:
+            return
+
+        for message_id, raws in self.mbox.iter_raws(mails):
+            yield message_id, self._load_commit(message_id, raws=raws)
+
+    def _sort_worklist(self, identifiers):
+        """
+        Commits first, followed by mails in the order they are stored. Chunks
+        of the worklist then read neighbouring mails.
+        """
+        commits = [x for x in identifiers if x[0] != '<']
+        mails = [x for x in identifiers if x[0] == '<']
+        if self.mbox:
+            mails = self.mbox.sort_by_location(mails)
+        return commits + mails
+
     def get_tree(self, revision):
         target = self.repo.revparse_single(revision)
         if isinstance(target, pygit2.Tag):
@@ -178,13 +429,21 @@ class Repository:
 
         return blob
 
-    def get_commit(self, identifier):
+    def get_commit(self, identifier, raw=False):
         """
         Get a particular commit
         :param identifier: Commit Hash or Message ID
+        :param raw: Rebuild the commit including its raw diff. Cached commits
+               don't carry raw diffs, hence this bypasses the cache.
         :return: Commit object
         """
 
+        if raw:
+            commit = self._load_commit(identifier, keep_raw=True)
+            if commit is None:
+                raise KeyError('Commit or Mail not found: %s' % identifier)
+            return commit
+
         # simply return commit if it is already cached
         if identifier in self.ccache:
             return self.ccache[identifier]
@@ -201,14 +460,102 @@ class Repository:
 
         return commit
 
+    def get_header(self, identifier):
+        """
+        Get the header of a particular commit. Headers are cheap: if neither
+        the header nor the commit is cached, the commit is loaded, but only
+        its header is kept.
+        :param identifier: Commit Hash or Message ID
+        :return: Header object
+        """
+        if identifier in self.hcache:
+            return self.hcache[identifier]
+
+        if identifier in self.ccache:
+            header = self.ccache[identifier].header
+        else:
+            commit = self._load_commit(identifier)
+            if commit is None:
+                raise KeyError('Commit or Mail not found: %s' % identifier)
+            header = commit.header
+
+        self.hcache[header.identifier] = header
+        return header
+
+    def get_author_date(self, identifier):
+        if self.meta and identifier in self.meta:
+            return self.meta.get_author_date(identifier)
+        return self.get_header(identifier).author.date
+
+    def get_committer_date(self, identifier):
+        if self.meta and identifier in self.meta:
+            return self.meta.get_committer_date(identifier)
+        return self.get_header(identifier).committer.date
+
+    def load_meta(self, f_meta):
+        self.meta = MetaIndex.load(f_meta)
+        return self.meta
+
+    def export_meta(self, f_meta):
+        """
+        Builds the metadata index from all cached headers
+        """
+        get_lists = self.mbox.get_lists if self.mbox else None
+        self.meta = MetaIndex.build(self.hcache.values(), get_lists)
+        self.meta.export(f_meta)
+
+    def cache_headers(self, identifiers, parallelise=True, cpu_factor=1):
+        """
+        Caches the headers of a list of identifiers. Commits that have to be
+        loaded for that purpose are dropped afterwards.
+        """
+        identifiers = set(identifiers)
+        worklist = identifiers - self.hcache.keys()
+
+        for identifier in worklist & self.ccache.keys():
+            self.hcache[identifier] = self.ccache[identifier].header
+        worklist -= self.ccache.keys()
+
+        if len(worklist) == 0:
+            return
+
+        log.info('Caching %d/%d headers' % (len(worklist), len(identifiers)))
+        loaded = self.cache_commits(worklist, parallelise, cpu_factor) & \
+                 worklist
+        for identifier in loaded:
+            self.hcache[identifier] = self.ccache.pop(identifier).header
+
+    def load_hcache(self, f_hcache, description):
+        log.info('Loading %s header cache' % description)
+        try:
+            loaded = set()
+            for headers in iter_chunks(f_hcache):
+                self.hcache.update(headers)
+                loaded |= headers.keys()
+            log.info('  ↪ Loaded %d headers from cache file' % len(loaded))
+            return loaded
+        except FileNotFoundError:
+            log.info('  ↪ Warning, header cache file %s not found!' % f_hcache)
+            return set()
+
+    def export_hcache(self, f_hcache):
+        """
+        Writes the headers of all cached commits
+        """
+        log.info('Writing %d headers to cache file' % len(self.ccache))
+        with open(f_hcache, 'wb') as f:
+            write_chunks(f, ((key, value.header) for key, value in
+                             self.ccache.items()))
+
     def load_ccache(self, f_ccache, description):
         log.info('Loading %s commit cache' % description)
         try:
-            with open(f_ccache, 'rb') as f:
-                this_commits = pickle.load(f)
-                log.info('  ↪ Loaded %d commits from cache file' % len(this_commits))
-            self._inject_commits(this_commits)
-            return set(this_commits.keys())
+            loaded = set()
+            for commits in iter_chunks(f_ccache, DiffUnpickler):
+                self._inject_commits(commits)
+                loaded |= commits.keys()
+            log.info('  ↪ Loaded %d commits from cache file' % len(loaded))
+            return loaded
         except FileNotFoundError:
             log.info('  ↪ Warning, commit cache file %s not found!' % f_ccache)
             return set()
@@ -216,7 +563,92 @@ class Repository:
     def export_ccache(self, f_ccache):
         log.info('Writing %d commits to cache file' % len(self.ccache))
         with open(f_ccache, 'wb') as f:
-            pickle.dump(self.ccache, f, pickle.HIGHEST_PROTOCOL)
+            write_chunks(f, self.ccache.items())
+
+    def load_dcache(self, f_dcache):
+        """
+        Opens the store of previously parsed diffs. Commit caches only refer
+        to diffs by their digest, diffs are read from the store on demand.
+        Diffs in the store won't be parsed again.
+        """
+        log.info('Loading diff cache')
+        if self.dcache is None or self.dcache.f_pack != f_dcache:
+            os.makedirs(dirname(f_dcache), exist_ok=True)
+            self.dcache = RawPack(f_dcache)
+            set_diff_store(self.dcache)
+        log.info('  ↪ %d diffs in cache file' % len(self.dcache))
+
+    def prune_dcache(self, f_hcaches):
+        """
+        Drops diffs from the diff cache that no commit in the commit caches
+        refers to any longer. Otherwise, the diff cache would only grow. The
+        header caches tell which diffs are referred to.
+        """
+        log.info('Pruning diff cache')
+        keep = set()
+        for f_hcache in f_hcaches:
+            if not isfile(f_hcache):
+                continue
+            for headers in iter_chunks(f_hcache):
+                keep |= {header.digest.hex() for header in headers.values()
+                         if header.digest is not None}
+
+        remaining = self.dcache.prune(keep)
+        log.info('  ↪ %d diffs remain' % remaining)
+
+    def prune_store(self, f_ccache, f_hcache, keep, description):
+        """
+        Drops everything but keep from an on-disk commit cache and its header
+        cache without loading the commit cache as a whole. The cheap header
+        cache tells which commits are stored. If it is missing, it is
+        regenerated. Diffs are resolved from the diff store, see load_dcache().
+        :return: tuple of identifiers that remain in the cache, and whether
+                 anything was pruned
+        """
+        log.info('Pruning %s commit cache' % description)
+        if not isfile(f_ccache):
+            log.info('  ↪ Warning, commit cache file %s not found!' % f_ccache)
+            # Headers without commits are stale
+            if isfile(f_hcache):
+                os.remove(f_hcache)
+            return set(), False
+
+        if isfile(f_hcache):
+            stored = set()
+            for headers in iter_chunks(f_hcache):
+                stored |= headers.keys()
+            if not stored - keep:
+                log.info('  ↪ %d commits, nothing to prune' % len(stored))
+                return stored, False
+
+        remaining = set()
+        pruned = False
+        f_ccache_tmp = f_ccache + '.tmp'
+        f_hcache_tmp = f_hcache + '.tmp'
+        with open(f_ccache_tmp, 'wb') as c, open(f_hcache_tmp, 'wb') as h:
+            for commits in iter_chunks(f_ccache, DiffUnpickler):
+                num = len(commits)
+                commits = {key: value for key, value in commits.items()
+                           if key in keep and key not in remaining}
+                pruned |= len(commits) < num
+                if not commits:
+                    continue
+                # Caches of older versions carry their diffs
+                diffs = {commit.diff.digest: commit.diff
+                         for commit in commits.values()
+                         if commit.diff.digest is not None and
+                         not diff_is_stored(commit.diff.digest)}
+                if diffs:
+                    self.dcache.append(map(encode_diff, diffs.values()))
+                DiffPickler(c, pickle.HIGHEST_PROTOCOL).dump(commits)
+                pickle.dump({key: value.header for key, value in
+                             commits.items()}, h, pickle.HIGHEST_PROTOCOL)
+                remaining |= commits.keys()
+        os.replace(f_ccache_tmp, f_ccache)
+        os.replace(f_hcache_tmp, f_hcache)
+
+        log.info('  ↪ %d commits remain' % len(remaining))
+        return remaining, pruned
 
     def cache_evict_except(self, commit_except):
         victims = self.ccache.keys() - commit_except
@@ -226,11 +658,73 @@ class Repository:
         gc.collect()
         return victims
 
-    def cache_commits(self, identifiers, parallelise=True, cpu_factor=1):
+    def _store_commits(self, worklist, store, parallelise, num_cpus):
+        """
+        Loads commits and appends them to the on-disk store. Workers write to
+        spill files of their own that are merged afterwards, so commits never
+        travel back to this process.
+        """
+        global _tmp_repo, _tmp_store
+        _tmp_repo = self
+        _tmp_store = store
+
+        for filename in store:
+            _remove_spills(filename)
+
+        worklist = self._sort_worklist(worklist)
+        chunks = [worklist[i:i + CACHE_CHUNK_SIZE]
+                  for i in range(0, len(worklist), CACHE_CHUNK_SIZE)]
+
+        if parallelise:
+            with ProcessPoolExecutor(max_workers=num_cpus,
+                                     initializer=_init_worker) as executor:
+                result = list(tqdm(executor.map(_store_commits_subst, chunks),
+                                   total=len(chunks)))
+        else:
+            result = list(tqdm(map(_store_commits_subst, chunks),
+                               total=len(chunks)))
+
+        _tmp_repo = None
+        _tmp_store = None
+
+        loaded = set()
+        invalid = set()
+        pids = set()
+        for pid, this_loaded, this_invalid in result:
+            pids.add(pid)
+            loaded.update(this_loaded)
+            invalid.update(this_invalid)
+
+        f_ccache, f_hcache, f_dcache = store
+        # Diffs must be stored before commits refer to them
+        spills = [_spill_location(f_dcache, pid) for pid in pids]
+        spills = [spill for spill in spills if isfile(spill)]
+        self.dcache.append(chain.from_iterable(
+            chain.from_iterable(iter_chunks(spill)) for spill in spills))
+        for spill in spills:
+            os.remove(spill)
+
+        for filename in (f_ccache, f_hcache):
+            with open(filename, 'ab') as dst:
+                for pid in pids:
+                    spill = _spill_location(filename, pid)
+                    if not isfile(spill):
+                        continue
+                    with open(spill, 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(spill)
+
+        return loaded, invalid
+
+    def cache_commits(self, identifiers, parallelise=True, cpu_factor=1,
+                      store=None):
         """
         Caches a list of commit hashes
         :param identifiers: List of identifiers
         :param parallelise: parallelise
+        :param store: Optional tuple of commit, header and diff cache files.
+               If given, commits are appended to those files instead of
+               being kept in memory. The diff cache must be loaded.
         """
         num_cpus = int(cpu_factor * cpu_count())
         # deactivate parallelistation, if we only have a single CPU
@@ -245,21 +739,32 @@ class Repository:
 
         log.info('Caching %d/%d commits' % (len(worklist), len(identifiers)))
 
-        if parallelise:
+        if store:
+            loaded, invalid = self._store_commits(worklist, store,
+                                                  parallelise, num_cpus)
+            result = dict()
+        elif parallelise:
             global _tmp_repo
             _tmp_repo = self
 
-            with ProcessPoolExecutor(max_workers=num_cpus) as executor:
-                result = list(tqdm(executor.map(_load_commit_subst, worklist,
-                                                chunksize=1000),
-                                   total=len(worklist)))
+            worklist = self._sort_worklist(worklist)
+            chunks = [worklist[i:i + CACHE_CHUNK_SIZE]
+                      for i in range(0, len(worklist), CACHE_CHUNK_SIZE)]
+            with ProcessPoolExecutor(max_workers=num_cpus,
+                                     initializer=_init_worker) as executor:
+                result = list(chain.from_iterable(
+                    tqdm(executor.map(_load_commits_subst, chunks),
+                         total=len(chunks))))
 
             _tmp_repo = None
         else:
-            result = list(map(lambda x: (x, self._load_commit(x)), worklist))
+            result = list(self._load_commits(worklist))
 
-        invalid = {key for (key, value) in result if value is None}
-        result = {key: value for (key, value) in result if value is not None}
+        if not store:
+            invalid = {key for (key, value) in result if value is None}
+            result = {key: value for (key, value) in result
+                      if value is not None}
+            loaded = result.keys()
 
         if self.mbox:
             invalid_mail = {x for x in invalid if x[0] == '<'}
@@ -267,14 +772,15 @@ class Repository:
 
         self._inject_commits(result)
 
-        return already_cached | set(result.keys())
+        return already_cached | set(loaded)
 
     def __getitem__(self, item):
         return self.get_commit(item)
 
     def __contains__(self, item):
-        if self.mbox and item in self.mbox:
-            return True
+        # Message ids never name git objects
+        if self.mbox and item.startswith('<'):
+            return item in self.mbox
 
         try:
             return item in self.repo
@@ -285,39 +791,103 @@ class Repository:
         if self.mbox and item in self.mbox:
             return self.mbox.get_raw(item)
 
-        commit = self[item]
-        return '\n'.join(commit.format_message() + commit.diff.raw)
+        commit = self.get_commit(item, raw=True)
+        return '\n'.join(commit.format_message() + list(commit.diff.raw))
 
     def get_commithash_range(self, range):
-        return get_commit_hash_range(self.repo_location, range)
+        return get_commit_hash_range(self.repo, range)
 
-    def cherry(self, base, stack):
+    def patch_ids(self, commit_hashes, parallelise=True):
         """
-        Returns the commit hashes on a patch stack
+        Computes patch ids, like git patch-id
+        :return: dict of commit hash to patch id
         """
-        repo = git.Repo(self.repo_location)
-        cherries = repo.git.cherry(base, stack).splitlines()
-        cherries = [x.split() for x in cherries]
+        commit_hashes = list(commit_hashes)
+        chunks = [commit_hashes[i:i + CACHE_CHUNK_SIZE]
+                  for i in range(0, len(commit_hashes), CACHE_CHUNK_SIZE)]
+
+        global _tmp_repo
+        _tmp_repo = self
+        if parallelise and cpu_count() > 1:
+            with ProcessPoolExecutor(max_workers=cpu_count(),
+                                     initializer=_init_worker) as executor:
+                result = list(tqdm(executor.map(_patch_ids_subst, chunks),
+                                   total=len(chunks), desc='Patch ids',
+                                   unit='chunk'))
+        else:
+            result = list(map(_patch_ids_subst, chunks))
+        _tmp_repo = None
 
-        has_removals = '-' in [x[0] for x in cherries]
-        if has_removals:
-            log.warning('Removals in patch stacks are not implemented!')
+        return {commit_hash: patch_id for chunk in result
+                for commit_hash, patch_id in chunk}
+
+    def cherries(self, ranges, parallelise=True):
+        """
+        Native replacement for 'git cherry' on several patch stacks at once.
+        Patch ids of all involved commits are computed in a single parallel
+        pass. Stacks that share their base and merge base share the patch ids
+        of upstream commits.
+        :param ranges: list of tuples of base and stack
+        :return: list of the commit hashes on each patch stack
+        """
+        stacks = list()
+        upstreams = dict()
+        for base, stack in ranges:
+            (stack,), (base,) = resolve_commit_range(self.repo,
+                                                     '%s..%s' % (base, stack))
+            merge_base = self.repo.merge_base(base, stack)
+            key = base, merge_base
+            if key not in upstreams:
+                exclude = [merge_base] if merge_base else []
+                upstreams[key] = walk_commits(self.repo, [base], exclude)
 
-        inserted_cherries = [x[1] for x in cherries]
+            stacks.append((key, walk_commits(self.repo, [stack], [base])))
 
-        # preserve order
-        return list(reversed(inserted_cherries))
+        worklist = {commit for commits in upstreams.values()
+                    for commit in commits}
+        for _, commits in stacks:
+            worklist.update(commits)
+
+        log.info('Calculating patch ids of %d commits' % len(worklist))
+        patch_ids = self.patch_ids(worklist, parallelise)
+
+        upstreams = {key: {patch_ids[commit] for commit in commits} - {None}
+                     for key, commits in upstreams.items()}
+
+        result = list()
+        for key, commits in stacks:
+            if any(patch_ids[commit] in upstreams[key] for commit in commits):
+                log.warning('Removals in patch stacks are not implemented!')
+
+            result.append(commits)
+
+        return result
+
+    def cherry(self, base, stack):
+        """
+        Returns the commit hashes on a patch stack
+        """
+        return self.cherries([(base, stack)])[0]
+
+    def reopen(self):
+        """
+        Reopens all repository handles, e.g., after forking
+        """
+        self.repo = pygit2.Repository(self.repo_location)
+        if self.mbox:
+            self.mbox.reopen()
 
     def register_mbox(self, config):
         if not self.mbox:
             self.mbox = Mbox(config)
 
-    def update_mbox(self, config):
+    def update_mbox(self, config, cpu_factor=1):
         self.register_mbox(config)
-        self.mbox.update()
+        self.mbox.update(cpu_factor)
 
         # The mbox doesn't track changes after an update. The easiest
         # workaround is to reload the whole instance.
         del self.mbox
         self.mbox = None
         self.register_mbox(config)
+        self.mbox.update_header_records()
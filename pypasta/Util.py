@@ -12,12 +12,12 @@ the COPYING file in the top-level directory.
 
 import argparse
 import datetime
-import dateparser
-import email
-import git
+import email.utils
+import functools
 import glob
 import os
 import pickle
+import pygit2
 import re
 import termios
 import tty
@@ -123,16 +123,79 @@ def load_pkl_and_update(filename, update_command, *params):
     return ret
 
 
+def iter_chunks(filename, unpickler=pickle.Unpickler):
+    """
+    On-disk caches are streams of pickled dicts. Chunks may be appended to
+    them, and later entries win.
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield unpickler(f).load()
+            except EOFError:
+                return
+
+
+def resolve_commit_range(repo, range):
+    """
+    Resolves a revision range to the commits that are included and excluded
+    Usage: resolve_commit_range(repo, 'v2.0..v2.1')
+           resolve_commit_range(repo, 'v2.0...v2.1')
+           resolve_commit_range(repo, '^v2.0 v2.1 v2.1.1')
+    :return: tuple of lists of included and excluded commit ids
+    """
+    def peel(revision):
+        return repo.revparse_single(revision).peel(pygit2.Commit).id
+
+    include = list()
+    exclude = list()
+    for revision in range.split():
+        if '...' in revision:
+            left, right = map(peel, revision.split('...', 1))
+            include += [left, right]
+            merge_base = repo.merge_base(left, right)
+            if merge_base:
+                exclude.append(merge_base)
+        elif '..' in revision:
+            left, right = revision.split('..', 1)
+            exclude.append(peel(left))
+            include.append(peel(right))
+        elif revision.startswith('^'):
+            exclude.append(peel(revision[1:]))
+        else:
+            include.append(peel(revision))
+
+    return include, exclude
+
+
+def walk_commits(repo, include, exclude=()):
+    """
+    Gets all hashes of non-merge commits that are reachable from include, but
+    not from exclude. Like git log, the newest commits come first.
+    """
+    if not include:
+        return []
+
+    walker = repo.walk(include[0], pygit2.GIT_SORT_TIME)
+    for id in include[1:]:
+        walker.push(id)
+    for id in exclude:
+        walker.hide(id)
+
+    return [str(commit.id) for commit in walker if len(commit.parent_ids) < 2]
+
+
 def get_commit_hash_range(d_repo, range):
-        """
-        Gets all commithashes within a certain range
-        Usage: get_commithash_range(dir, 'v2.0..v2.1')
-               get_commithash_range(dir, 'v3.0')
-        """
+    """
+    Gets all commithashes within a certain range
+    Usage: get_commithash_range(dir, 'v2.0..v2.1')
+           get_commithash_range(dir, 'v3.0')
+    """
+    repo = d_repo
+    if not isinstance(repo, pygit2.Repository):
+        repo = pygit2.Repository(d_repo)
 
-        # we use git.Repo, as pygit doesn't support this nifty log functionality
-        repo = git.Repo(d_repo)
-        return repo.git.log('--pretty=format:%H', '--no-merges', range).splitlines()
+    return walk_commits(repo, *resolve_commit_range(repo, range))
 
 
 def get_date_selector(repo, patch_stack_definition, selector):
@@ -141,16 +204,16 @@ def get_date_selector(repo, patch_stack_definition, selector):
         date_selector = lambda x: patch_stack_definition.get_stack_of_commit(x).stack_release_date
     # Date selector "Commit Date"
     elif selector == 'CD':
-        date_selector = lambda x: repo[x].commit.date
+        date_selector = lambda x: repo.get_committer_date(x)
     elif selector == 'AD':
-        date_selector = lambda x: repo[x].author.date
+        date_selector = lambda x: repo.get_author_date(x)
     else:
         raise NotImplementedError('Unknown date selector: ' % selector)
     return date_selector
 
 
-def persist_commit_hashes(filename, commit_hashes):
-    with open(filename, 'w') as f:
+def persist_commit_hashes(filename, commit_hashes, append=False):
+    with open(filename, 'a' if append else 'w') as f:
         f.write('\n'.join(commit_hashes) + '\n')
 
 
@@ -201,20 +264,91 @@ def parse_date_ymd(ymd):
         raise argparse.ArgumentTypeError("Not a valid date: '%s'" % ymd)
 
 
-def mail_parse_date(date_str, assume_epoch=False):
+# Frequent malformed date formats that email.utils rejects, but that are
+# unambiguous enough to be parsed without dateparser
+MAIL_DATE_ISO_REGEX = re.compile(
+    r'\s*(?:\w+,?\s+)?(\d{4})-(\d{1,2})-(\d{1,2})[T ]\s*'
+    r'(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?\s*'
+    r'(Z|UTC|GMT|[+-]\d{2}:?\d{2})?(?:\s*\(.*\))?\s*$', re.IGNORECASE)
+MAIL_DATE_LOCALISED_MONTHS = {
+    'januar': 'Jan', 'jän': 'Jan', 'februar': 'Feb', 'mär': 'Mar',
+    'märz': 'Mar', 'mrz': 'Mar', 'mai': 'May', 'juni': 'Jun', 'juli': 'Jul',
+    'okt': 'Oct', 'oktober': 'Oct', 'dez': 'Dec', 'dezember': 'Dec',
+}
+MAIL_DATE_WORD_REGEX = re.compile(r'[^\W\d_]+')
+MAIL_DATE_EPOCH = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+MAIL_DATE_CACHE_SIZE = 1 << 16
+
+# How mail dates were resolved in this process
+mail_date_stats = {
+    'email': 0,
+    'fast': 0,
+    'dateparser': 0,
+    'failed': 0,
+}
+
+
+def _mail_parse_date_iso(date_str):
+    match = MAIL_DATE_ISO_REGEX.match(date_str)
+    if not match:
+        return None
+
+    year, month, day, hour, minute, second, tz = match.groups()
+    tzinfo = datetime.timezone.utc
+    if tz and tz[0] in '+-':
+        tz = tz.replace(':', '')
+        offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+        if tz[0] == '-':
+            offset = -offset
+        tzinfo = datetime.timezone(offset)
+
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second or 0), tzinfo=tzinfo)
+
+
+def _mail_parse_date_localised(date_str):
+    # Drop the weekday and translate month names, then retry email.utils
+    words = MAIL_DATE_WORD_REGEX.findall(date_str)
+    if not any(word.lower() in MAIL_DATE_LOCALISED_MONTHS for word in words):
+        return None
+
+    date_str = date_str.split(',', 1)[-1]
+    date_str = MAIL_DATE_WORD_REGEX.sub(
+        lambda m: MAIL_DATE_LOCALISED_MONTHS.get(m.group(0).lower(),
+                                                 m.group(0)), date_str)
+    return email.utils.parsedate_to_datetime(date_str)
+
+
+def _mail_parse_date(date_str):
     try:
         date = email.utils.parsedate_to_datetime(date_str)
     except Exception:
         date = None
 
+    if date:
+        mail_date_stats['email'] += 1
+    else:
+        for parser in (_mail_parse_date_iso, _mail_parse_date_localised):
+            try:
+                date = parser(date_str)
+            except Exception:
+                date = None
+            if date:
+                mail_date_stats['fast'] += 1
+                break
+
     if not date:
+        import dateparser
         try:
             date = dateparser.parse(date_str)
         except Exception:
             date = None
+        if date:
+            mail_date_stats['dateparser'] += 1
 
     if not date:
-        date = datetime.datetime.utcfromtimestamp(0)
+        mail_date_stats['failed'] += 1
+        return MAIL_DATE_EPOCH
 
     if date.tzinfo is None:
         date = date.replace(tzinfo=datetime.timezone.utc)
@@ -222,6 +356,45 @@ def mail_parse_date(date_str, assume_epoch=False):
     return date
 
 
+_mail_parse_date_cached = functools.lru_cache(
+    maxsize=MAIL_DATE_CACHE_SIZE)(_mail_parse_date)
+
+
+def mail_parse_date(date_str, assume_epoch=False):
+    """
+    Parse the Date header of a mail. Results are memoised by the raw header
+    value: the same mail is parsed several times on its way through PaStA.
+    Unparseable dates are mapped to the epoch.
+    """
+    if isinstance(date_str, str):
+        return _mail_parse_date_cached(date_str)
+    # Undecodable headers come as email.header.Header, which isn't hashable
+    return _mail_parse_date(date_str)
+
+
+def get_mail_date_stats():
+    info = _mail_parse_date_cached.cache_info()
+    return dict(mail_date_stats, hits=info.hits, misses=info.misses)
+
+
+def log_mail_date_stats(stats=None):
+    """
+    :param stats: Statistics collected by get_mail_date_stats(), e.g., of
+           other processes. Defaults to those of this process.
+    """
+    if stats is None:
+        stats = get_mail_date_stats()
+
+    lookups = stats['hits'] + stats['misses']
+    if not lookups:
+        return
+
+    log.info('  ↪ mail dates: %d lookups, %.1f%% memo hits, parsed by '
+             'email: %d, fast patterns: %d, dateparser: %d, failed: %d' %
+             (lookups, 100 * stats['hits'] / lookups, stats['email'],
+              stats['fast'], stats['dateparser'], stats['failed']))
+
+
 def getch():
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
@@ -262,7 +435,7 @@ def pager(text, enable_pager=True):
 
 
 def show_commit(repo, hash, enable_pager=True):
-    commit = repo[hash]
+    commit = repo.get_commit(hash, raw=True)
     content = commit.format_message()
     if commit.annotation is not None:
         content.append('---')
@@ -286,8 +459,8 @@ def show_commits(repo, left_hash, right_hash, enable_pager=True):
             ret.append(line)
         return ret
 
-    left_commit = repo[left_hash]
-    right_commit = repo[right_hash]
+    left_commit = repo.get_commit(left_hash, raw=True)
+    right_commit = repo.get_commit(right_hash, raw=True)
 
     left_message = left_commit.format_message()
     right_message = right_commit.format_message()
@@ -322,4 +495,4 @@ def get_first_upstream(repo, cluster, commit):
     upstream = cluster.get_upstream(commit)
     if not upstream:
         return None
-    return min(upstream, key=lambda x: repo[x].committer.date)
+    return min(upstream, key=lambda x: repo.get_committer_date(x))
@@ -0,0 +1,60 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pytest
+import shutil
+import subprocess
+
+from glob import glob
+from os.path import dirname, join, splitext
+
+from pypasta.Repository.Patch import Diff
+
+# Pairs of context diffs (GNU diff -c) and their unified counterparts (GNU
+# diff -u, with the file headers of the context diff). test_filterdiff checks
+# the conversion against filterdiff --format=unified itself.
+d_fixtures = join(dirname(__file__), 'fixtures', 'context_diffs')
+fixtures = sorted(splitext(f)[0] for f in
+                  glob(join(d_fixtures, '*.context')))
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        return f.read().split('\n')
+
+
+@pytest.mark.parametrize('fixture', fixtures,
+                         ids=[splitext(f)[0].split('/')[-1] for f in fixtures])
+def test_context_to_unified(fixture):
+    context = read_lines(fixture + '.context')
+    unified = read_lines(fixture + '.unified')
+
+    assert Diff.context_to_unified(context) == unified
+
+
+@pytest.mark.skipif(not shutil.which('filterdiff'),
+                    reason='filterdiff is not installed')
+@pytest.mark.parametrize('fixture', fixtures,
+                         ids=[splitext(f)[0].split('/')[-1] for f in fixtures])
+def test_filterdiff(fixture):
+    filterdiff = subprocess.run(['filterdiff', '--format=unified',
+                                 fixture + '.context'], capture_output=True,
+                                text=True, check=True).stdout
+
+    assert Diff.context_to_unified(read_lines(fixture + '.context')) == \
+           filterdiff.split('\n')
+
+
+def test_unconvertible():
+    with pytest.raises(ValueError):
+        Diff.context_to_unified(['***************', '*** 1,2 ****',
+                                 '  foo', '  bar'])
@@ -0,0 +1,160 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2021
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import email
+import pytest
+import random
+
+from pypasta.Repository.Mbox import SimpleMail, decode_payload, \
+    parse_simple_mail
+
+PATCH = '''Signed-off-by: {name} <{addr}>
+---
+ foo.c | 2 +-
+ 1 file changed, 1 insertion(+), 1 deletion(-)
+
+diff --git a/foo.c b/foo.c
+index 1234567..89abcde 100644
+--- a/foo.c
++++ b/foo.c
+@@ -1,3 +1,3 @@
+ int main(void)
+ {{
+-\treturn 0;
++\treturn {ret};
+ }}
+--
+2.30.0
+'''
+
+NAMES = ['Jane Doe', '"Doe, Jane"', 'Jörg Müller',
+         '=?utf-8?q?J=C3=B6rg_M=C3=BCller?=',
+         '=?UTF-8?B?w4FsdmFybyBHw7Nteg==?=']
+SUBJECTS = ['[PATCH] foo: fix return value',
+            '[PATCH v2 3/7] foo: a rather long subject line that got folded '
+            'by the mailer\n\tinto two lines',
+            '=?utf-8?q?=5BPATCH=5D_foo=3A_f=C3=BCx?=',
+            '[PATCH] =?utf-8?b?Zm9vOiBmw7x4?=\n =?utf-8?b?IGJhcg==?=',
+            '']
+CONTENT_TYPES = [None, 'text/plain', 'text/plain; charset=UTF-8',
+                 'text/plain; charset="utf-8"; format=flowed',
+                 'TEXT/PLAIN;\n\tcharset=iso-8859-1',
+                 'text/plain; charset=unknown-8bit',
+                 'text/plain; charset*=utf-8\'\'utf-8',
+                 'multipart/mixed; boundary="xyz"']
+ENCODINGS = [None, '7bit', '8bit', 'binary', 'quoted-printable', 'base64']
+
+
+def generate_mail(rnd):
+    name = rnd.choice(NAMES)
+    addr = 'jane.doe@example.com'
+    author = '%s <%s>' % (name, addr)
+    if rnd.random() < 0.2:
+        author = '%s\n <%s>' % (name, addr)
+
+    headers = [('From', author),
+               ('Date', 'Mon, %d Feb 2021 10:%02d:00 +0100' %
+                (rnd.randint(1, 28), rnd.randint(0, 59))),
+               ('Subject', rnd.choice(SUBJECTS)),
+               ('Message-Id', '<%d@example.com>' % rnd.getrandbits(32)),
+               ('To', 'list@example.com'),
+               ('X-Mailer', 'git-send-email 2.30.0')]
+    content_type = rnd.choice(CONTENT_TYPES)
+    if content_type:
+        headers.append(('Content-Type', content_type))
+    encoding = rnd.choice(ENCODINGS)
+    if encoding:
+        headers.append(('Content-Transfer-Encoding', encoding))
+
+    # Missing headers, duplicate headers
+    for _ in range(rnd.randint(0, 2)):
+        del headers[rnd.randrange(len(headers))]
+    if rnd.random() < 0.1:
+        headers.append(('Subject', 'Re: a second subject'))
+
+    rnd.shuffle(headers)
+    lines = ['%s: %s' % header for header in headers]
+    if rnd.random() < 0.2:
+        lines.insert(0, 'From 1234567890abcdef Mon Sep 17 00:00:00 2001')
+
+    body = PATCH.format(name=name, addr=addr, ret=rnd.randint(0, 9))
+    mail = '\n'.join(lines) + '\n\n' + body
+    if rnd.random() < 0.2:
+        mail = mail.replace('\n', '\r\n')
+
+    charset = 'utf-8' if rnd.random() < 0.8 else 'latin-1'
+    return mail.encode(charset, errors='replace')
+
+
+def slow_path(raw):
+    mail = email.message_from_bytes(raw)
+    return SimpleMail(mail['Date'], mail['Subject'], str(mail['From']),
+                      decode_payload(mail))
+
+
+corpus = [generate_mail(random.Random(seed)) for seed in range(2000)]
+
+
+def test_corpus():
+    simple = 0
+    for raw in corpus:
+        mail = parse_simple_mail(raw)
+        if mail is None:
+            continue
+
+        simple += 1
+        assert mail == slow_path(raw), raw
+
+    # Most of the corpus must take the fast path
+    assert simple > len(corpus) // 4
+
+
+@pytest.mark.parametrize('raw', [
+    # Folded headers and encoded words stay raw
+    b'From: =?utf-8?q?J=C3=B6rg?=\n <joerg@example.com>\n'
+    b'Subject: [PATCH] foo:\n\t=?utf-8?b?Zm9v?=\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\n'
+    b'Message-Id: <1@example.com>\n\nfoo\n',
+    # Envelope line, CRLF, quoted charset
+    b'From 1234 Mon Sep 17 00:00:00 2001\r\n'
+    b'From: Jane Doe <jane@example.com>\r\n'
+    b'Subject: [PATCH] foo\r\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\r\n'
+    b'Content-Type: text/plain; charset="iso-8859-1"\r\n\r\nf\xf6\xf6\r\n',
+    # No Message-Id
+    b'From: Jane Doe <jane@example.com>\n'
+    b'Subject: [PATCH] foo\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\n\nfoo\n',
+], ids=['folded_encoded', 'envelope_crlf', 'no_message_id'])
+def test_simple(raw):
+    mail = parse_simple_mail(raw)
+    assert mail is not None
+    assert mail == slow_path(raw)
+
+
+@pytest.mark.parametrize('raw', [
+    b'From: Jane Doe <jane@example.com>\n'
+    b'Subject: [PATCH] foo\n\nfoo\n',
+    b'From: Jane Doe <jane@example.com>\n'
+    b'Subject: [PATCH] foo\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\n'
+    b'Content-Transfer-Encoding: base64\n\nZm9vCg==\n',
+    b'From: Jane Doe <jane@example.com>\n'
+    b'Subject: [PATCH] foo\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\n'
+    b'Content-Type: multipart/mixed; boundary="x"\n\n--x\n\nfoo\n--x--\n',
+    b'From: J\xc3\xb6rg <joerg@example.com>\n'
+    b'Subject: [PATCH] foo\n'
+    b'Date: Mon, 1 Feb 2021 10:00:00 +0100\n\nfoo\n',
+], ids=['no_date', 'base64', 'multipart', 'non_ascii_header'])
+def test_not_simple(raw):
+    assert parse_simple_mail(raw) is None